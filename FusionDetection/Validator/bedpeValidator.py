@@ -4,6 +4,7 @@ import sys
 import os
 import math
 import getopt
+from chromosomeTable import load_chromosome_table
 
 def usage():
     print """
@@ -18,9 +19,11 @@ def usage():
         -s/--is-strict-1        [Change to True. Default: False  No user strings in column 7           ]
         -x/--is-strict-2        [Change to True. Default: False  No user scores in column 8            ]
         -d/--is-keep-dot        [Change to True. Default: False  Not keeping lines with strands as dots]
-                                [Warning: if False, also not attemping to remove duplicate transcripts ]
+                                [Warning: if True, also not attemping to remove duplicate transcripts  ]
+        -e/--max-errors         [int. Default: 0                 Report up to this many invalid rows   ]
+                                [instead of stopping at the first one                                  ]
     
-    Version:                    1.0.1
+    Version:                    1.2.0
           """
 
 
@@ -31,16 +34,18 @@ outResFile = ''              #output bedpe
 isStrict1 = False            #If True, change column 7 to "nameX"  
 isStrict2 = False            #If True, change colomn 8 to 0
 isKeepDotInStrand = False    #If True, keeps the records with dots in strands
+maxErrors = 0                #If >0, reports up to this many invalid rows
 
 def getParameters(argv):
     try:
-        opts, args = getopt.getopt(argv,"hc:i:o:sxd",["help",
+        opts, args = getopt.getopt(argv,"hc:i:o:sxde:",["help",
                                                      "chromosome-file=",
                                                      "input-file=",
                                                      "output-file=",
                                                      "is-strict-1",
                                                      "is-strict-2",
-                                                     "is-keep-dot"])
+                                                     "is-keep-dot",
+                                                     "max-errors="])
     except getopt.GetoptError:
         usage()
         sys.exit(1)
@@ -66,61 +71,42 @@ def getParameters(argv):
         elif opt in ("-d","--is-keep-dot"):
             global isKeepDotInStrand
             isKeepDotInStrand = True
+        elif opt in ("-e","--max-errors"):
+            global maxErrors
+            maxErrors = int(arg)
 
 
 
-string_to_valid = {} #allowed chr name to target chr name
+class ValidationError(Exception):
+    def __init__(self, message, category='invalid'):
+        Exception.__init__(self, message)
+        self.category = category      #kind of check that failed, for reports
 
-valid_to_length = {} #target chr length
+def add_error(errors,row,error):
+    errors.append({'row': row, 'category': error.category, 'message': str(error)})
 
-out_data = [] #keep output
+def print_errors(errors,maxErrors):
+    print "row\tcategory\tmessage"
+    for error in errors:
+        print "%d\t%s\t%s" % (error['row'],error['category'],error['message'])
+    if len(errors)>=maxErrors:
+        print "Stopped after %d errors." % maxErrors
 
-def get_valid_name_length(fileName):
-    infile = "%s" % fileName
-    f=open(infile,"r")
-    f.readline()
-    while True:
-        line=f.readline()
-        if line=="":
-            break
-        else:
-            tmp=line.split("\t")
-            target=tmp[0]
-            length=int(tmp[1])
-            allowed=tmp[2].split(",")
-            if len(allowed) > 0:
-                allowed[len(allowed)-1]= allowed[len(allowed)-1][0:len(allowed[len(allowed)-1])-1]
-            for i in range(len(allowed)):
-                if allowed[i]!='':
-                    string_to_valid[allowed[i]]=target
-                    valid_to_length[target]=length
-    #for x in string_to_valid:
-    #    print "%s:%s" % (x,string_to_valid[x])
-    #for x in valid_to_length:
-    #    print "%s:%d" % (x,valid_to_length[x])
-    f.close()
-
-
-def get_target(name):
-    try:
-        target=string_to_valid[name]
-    except KeyError:
-        print "Chromosome name \""+name+"\"" " is not allowed."
-        sys.exit(1)
+def get_target(name,table):
+    target=table.get(name)
+    if target is None:
+        raise ValidationError("Chromosome name \""+name+"\"" " is not allowed.","chromosome")
     return target
 
 def get_integer(message):
     try:
         userInput = int(message)       
     except ValueError:
-        print "Position \""+message+"\"" " is not an integer."
-        sys.exit(1)
+        raise ValidationError("Position \""+message+"\"" " is not an integer.","position")
     return userInput 
 
-def get_length(target):
-    return valid_to_length[target]    
-
-def valid_pos_pair(pos1,pos2,length):
+def valid_pos_pair(pos1,pos2,length,notes):
+    #notes collects the messages that do not stop the validation
     ism1_1=True
     ism1_2=True
     if(pos1!=-1):
@@ -128,28 +114,24 @@ def valid_pos_pair(pos1,pos2,length):
     if(pos2!=-1):
         ism1_2=False
     if ism1_1 and ism1_2:
-        print "Positions -1 -1 are not allowed."
+        notes.append("Positions -1 -1 are not allowed.")
     if ism1_1 and (not ism1_2):
         if pos2>length or pos2<1:
-            print "Position",pos2,"out of range" 
-            sys.exit(1)
+            raise ValidationError("Position %s out of range" % pos2,"position")
     if (not ism1_1) and ism1_2:
         if pos1+1>length or pos1+1<1:
-            print "Position",pos1,"out of range"
-            sys.exit(1)
+            raise ValidationError("Position %s out of range" % pos1,"position")
     if (not ism1_1) and (not ism1_2):
         if pos1+1>pos2:
-            print "Position",pos1,"+1 >",pos2
-            sys.exit(1)
+            raise ValidationError("Position %s +1 > %s" % (pos1,pos2),"position")
         if pos1+1<1:
-             print "Position",pos1,"out of range"
+             notes.append("Position %s out of range" % pos1)
         if pos2>length:
-             print "Position",pos2,"out of range"
+             notes.append("Position %s out of range" % pos2)
 
 def valid_strand(strand):
     if not (strand=="+" or strand=="-" or strand=="."):
-        print "Strand should only contain +/-/."
-        sys.exit(1)
+        raise ValidationError("Strand should only contain +/-/.","strand")
     return strand
 
 def is_contain_dot(strand1,strand2):
@@ -158,27 +140,52 @@ def is_contain_dot(strand1,strand2):
     else:
         return False
 
-def validate_file(fileName):
+def validate_line(line,table,notes):
+    tmp=line.split("\t")
+    if(len(tmp)<10):
+        raise ValidationError("Number of columns of bedpe for fusion should >=10.","columns")
+    tmp[len(tmp)-1] = tmp[len(tmp)-1][0:len(tmp[len(tmp)-1])-1]
+    chr1,length1=get_target(tmp[0],table)
+    tmp[0]=chr1
+    valid_pos_pair(get_integer(tmp[1]),get_integer(tmp[2]),length1,notes)
+    chr2,length2=get_target(tmp[3],table)
+    tmp[3]=chr2
+    valid_pos_pair(get_integer(tmp[4]),get_integer(tmp[5]),length2,notes)
+    valid_strand(tmp[8])
+    valid_strand(tmp[9])
+    return tmp
+
+def validate_file(fileName,table,isStrict1=False,isStrict2=False,isKeepDotInStrand=False,notes=None,errors=None,maxErrors=100):
+    """
+    Validates a bedpe file and returns its rows with the target chromosome
+    names. Raises ValidationError at the first invalid row, unless an errors
+    list is given: each invalid row is then skipped and added to it as a
+    dictionary with its 'row' number, 'category' and 'message', and reading
+    stops once the list holds maxErrors entries.
+    """
+    if notes is None:
+        notes=[]
+    out_data=[]
     infile = "%s" % fileName
     f=open(infile,"r")
     index=0
+    row=0
     while True:
         line=f.readline()
         if line=="":
             break
         else:
-            tmp=line.split("\t")
-            if(len(tmp)<10):
-                print "Number of columns of bedpe for fusion should >=10."
-                exit(1)
-            tmp[len(tmp)-1] = tmp[len(tmp)-1][0:len(tmp[len(tmp)-1])-1]
-            chr1=get_target(tmp[0])
-            tmp[0]=chr1
-            valid_pos_pair(get_integer(tmp[1]),get_integer(tmp[2]),get_length(chr1))
-            chr2=get_target(tmp[3])
-            tmp[3]=chr2
-            valid_pos_pair(get_integer(tmp[4]),get_integer(tmp[5]),get_length(chr2))
-            iscd=is_contain_dot(valid_strand(tmp[8]),valid_strand(tmp[9]))
+            row=row+1
+            try:
+                tmp=validate_line(line,table,notes)
+            except ValidationError as e:
+                if errors is None:
+                    raise
+                add_error(errors,row,e)
+                if len(errors)>=maxErrors:
+                    break
+                continue
+            iscd=is_contain_dot(tmp[8],tmp[9])
             if isKeepDotInStrand==False and iscd==True:
                 continue
             else:
@@ -189,51 +196,47 @@ def validate_file(fileName):
                 out_data.append(tmp) 
                 index=index+1
     f.close()
+    return out_data
 
-def remove_duplicate():
-    global out_data
-    if isKeepDotInStrand==True:
-        return
+def get_breakpoint_key(row):
+    """
+    Returns the key of the fusion described by a row and its strand-adjusted
+    positions. Two rows whose positions differ by the same strand-adjusted
+    delta on both sides share sign1*pos1-sign2*pos2, and so share the key.
+    """
+    if row[8]=="+":
+        pos1=int(row[2])
+        offset=pos1
     else:
-        for i in range(len(out_data)):
-            pos1=0
-            pos2=0
-            if out_data[i][8]=="+":
-                pos1=out_data[i][2]
-            else:
-                pos1=out_data[i][1]
-            if out_data[i][9]=="+":
-                pos2=out_data[i][4]
-            else:
-                pos2=out_data[i][5]
-            out_data[i].append(get_integer(pos1))
-            out_data[i].append(get_integer(pos2))
-        
-        out_data = sorted(out_data, key = lambda x: (x[0], x[3], x[8], x[9], x[10], x[11]))
-        out_data_2 = []
-        for i in range(len(out_data)):
-            if i==0:
-                out_data_2.append(out_data[i])
-            if i>=1:
-                if out_data[i][0]==out_data[i-1][0] and out_data[i][3]==out_data[i-1][3] and out_data[i][8]==out_data[i-1][8] and out_data[i][9]==out_data[i-1][9]:
-                    delta1=0
-                    delta2=0
-                    lenRow=len(out_data[i])
-                    if out_data[i][8]=="+":
-                        delta1 = out_data[i][lenRow-2]-out_data[i-1][lenRow-2]
-                    else:
-                        delta1 = out_data[i-1][lenRow-2]-out_data[i][lenRow-2]
-                    if out_data[i][9]=="+":
-                        delta2 = out_data[i][lenRow-1]-out_data[i-1][lenRow-1]
-                    else:
-                        delta2 = out_data[i-1][lenRow-1]-out_data[i][lenRow-1]
-                    if delta1 !=delta2:
-                        out_data_2.append(out_data[i])
-                else:
-                    out_data_2.append(out_data[i])
-        out_data=out_data_2
+        pos1=int(row[1])
+        offset=-pos1
+    if row[9]=="+":
+        pos2=int(row[4])
+        offset=offset-pos2
+    else:
+        pos2=int(row[5])
+        offset=offset+pos2
+    return (row[0],row[3],row[8],row[9],offset),pos1,pos2
 
-def print_to_file(fileName):
+def remove_duplicate(out_data,isKeepDotInStrand=False):
+    """
+    Keeps one row per fusion, the one with the smallest positions, and
+    returns the kept rows in input order. Rows are not modified.
+    """
+    if isKeepDotInStrand==True:
+        return out_data
+    keys=[]
+    for i in range(len(out_data)):
+        key,pos1,pos2=get_breakpoint_key(out_data[i])
+        keys.append(key+(pos1,pos2,i))
+    keys.sort()
+    keep=[False]*len(out_data)
+    for i in range(len(keys)):
+        if i==0 or keys[i][0:5]!=keys[i-1][0:5]:
+            keep[keys[i][7]]=True
+    return [out_data[i] for i in range(len(out_data)) if keep[i]]
+
+def print_to_file(fileName,out_data):
 
     outfile = "%s" % fileName
     f=open(outfile,"w")
@@ -246,24 +249,42 @@ def print_to_file(fileName):
         f.write("\n") 
     f.close()    
 
+def validate_bedpe(chrFile,inFile,isStrict1=False,isStrict2=False,isKeepDotInStrand=False):
+    """
+    Validates a bedpe file against a chromosome file. Returns the validated
+    rows and the list of messages that did not stop the validation.
+    Raises ValidationError at the first invalid row.
+    """
+    notes=[]
+    table=load_chromosome_table(chrFile)
+    out_data=validate_file(inFile,table,isStrict1,isStrict2,isKeepDotInStrand,notes)
+    return out_data,notes
 
-if __name__ == '__main__':
-    getParameters(sys.argv[1:])
+def main(argv):
+    getParameters(argv[1:])
     if inChrFile=='' or inResFile=='' or outResFile=='':
         usage()
-        sys.exit(0)
-	
-    #print "inResFile:\t", inResFile
-    #print "outResFile:\t", outResFile
-    #print "inChrFile:\t", inChrFile
-    #print "isStrict:\t", isStrict
-    #print "sKeepDotInStrand:\t", isKeepDotInStrand
-
-
-    get_valid_name_length(inChrFile)
-    
-    validate_file(inResFile)
-   
-    #remove_duplicate()
+        return 0
+    notes=[]
+    errors=None
+    if maxErrors>0:
+        errors=[]
+    try:
+        table=load_chromosome_table(inChrFile)
+        out_data=validate_file(inResFile,table,isStrict1,isStrict2,isKeepDotInStrand,notes,errors,maxErrors)
+    except ValidationError as e:
+        for note in notes:
+            print note
+        print e
+        return 1
+    for note in notes:
+        print note
+    if errors:
+        print_errors(errors,maxErrors)
+        return 1
+    out_data=remove_duplicate(out_data,isKeepDotInStrand)
+    print_to_file(outResFile,out_data)
+    return 0
 
-    print_to_file(outResFile) 
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
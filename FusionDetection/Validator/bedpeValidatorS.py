@@ -4,6 +4,7 @@ import sys
 import os
 import math
 import getopt
+from chromosomeTable import load_chromosome_table
 
 def usage():
     print """
@@ -13,19 +14,25 @@ def usage():
         -c/--chromosome-file    [string:    path to chromosome file]
         -i/--input-file         [string:    path to input bedpe    ]
 
-    Version:                    s1.0.0 (Simple Check Version)
+    Optional Parameters:
+        -e/--max-errors         [int. Default: 0                 Report up to this many invalid rows   ]
+                                [instead of stopping at the first one                                  ]
+
+    Version:                    s1.1.0 (Simple Check Version)
           """
 
 
 #parameters
 inChrFile= ''                #input chromosome file
 inResFile = ''               #input bedpe
+maxErrors = 0                #If >0, reports up to this many invalid rows
 
 def getParameters(argv):
     try:
-        opts, args = getopt.getopt(argv,"hc:i:",["help",
+        opts, args = getopt.getopt(argv,"hc:i:e:",["help",
                                                      "chromosome-file=",
-                                                     "input-file="])
+                                                     "input-file=",
+                                                     "max-errors="])
     except getopt.GetoptError:
         usage()
         sys.exit(1)
@@ -39,52 +46,40 @@ def getParameters(argv):
         elif opt in ("-c","--chromosome-file"):
             global inChrFile
             inChrFile = arg
-
-string_to_valid = {} #allowed chr name to target chr name
-
-valid_to_length = {} #target chr length
-
-def get_valid_name_length(fileName):
-    infile = "%s" % fileName
-    f=open(infile,"r")
-    f.readline()
-    while True:
-        line=f.readline()
-        if line=="":
-            break
-        else:
-            tmp=line.split("\t")
-            target=tmp[0]
-            length=int(tmp[1])
-            allowed=tmp[2].split(",")
-            if len(allowed) > 0:
-                allowed[len(allowed)-1]= allowed[len(allowed)-1][0:len(allowed[len(allowed)-1])-1]
-            for i in range(len(allowed)):
-                if allowed[i]!='':
-                    string_to_valid[allowed[i]]=target
-                    valid_to_length[target]=length
-    f.close()
-
-def get_target(name):
-    try:
-        target=string_to_valid[name]
-    except KeyError:
-        print "Chromosome name \""+name+"\"" " is not allowed."
-        sys.exit(1)
+        elif opt in ("-e","--max-errors"):
+            global maxErrors
+            maxErrors = int(arg)
+
+class ValidationError(Exception):
+    def __init__(self, message, category='invalid'):
+        Exception.__init__(self, message)
+        self.category = category      #kind of check that failed, for reports
+
+def add_error(errors,row,error):
+    errors.append({'row': row, 'category': error.category, 'message': str(error)})
+
+def print_errors(errors,maxErrors):
+    print "row\tcategory\tmessage"
+    for error in errors:
+        print "%d\t%s\t%s" % (error['row'],error['category'],error['message'])
+    if len(errors)>=maxErrors:
+        print "Stopped after %d errors." % maxErrors
+
+def get_target(name,table):
+    target=table.get(name)
+    if target is None:
+        raise ValidationError("Chromosome name \""+name+"\"" " is not allowed.","chromosome")
     return target
 
 def get_integer(message):
     try:
         userInput = int(message)       
     except ValueError:
-        print "Position \""+message+"\"" " is not an integer."
-        sys.exit(1)
+        raise ValidationError("Position \""+message+"\"" " is not an integer.","position")
     return userInput 
 
-def get_length(target):
-    return valid_to_length[target]    
-
-def valid_pos_pair(pos1,pos2,length):
+def valid_pos_pair(pos1,pos2,length,notes):
+    #notes collects the messages that do not stop the validation
     ism1_1=True
     ism1_2=True
     if(pos1!=-1):
@@ -92,28 +87,24 @@ def valid_pos_pair(pos1,pos2,length):
     if(pos2!=-1):
         ism1_2=False
     if ism1_1 and ism1_2:
-        print "Positions -1 -1 are not allowed."
+        notes.append("Positions -1 -1 are not allowed.")
     if ism1_1 and (not ism1_2):
         if pos2>length or pos2<1:
-            print "Position",pos2,"out of range" 
-            sys.exit(1)
+            raise ValidationError("Position %s out of range" % pos2,"position")
     if (not ism1_1) and ism1_2:
         if pos1+1>length or pos1+1<1:
-            print "Position",pos1,"out of range"
-            sys.exit(1)
+            raise ValidationError("Position %s out of range" % pos1,"position")
     if (not ism1_1) and (not ism1_2):
         if pos1+1>pos2:
-            print "Position",pos1,"+1 >",pos2
-            sys.exit(1)
+            raise ValidationError("Position %s +1 > %s" % (pos1,pos2),"position")
         if pos1+1<1:
-             print "Position",pos1,"out of range"
+             notes.append("Position %s out of range" % pos1)
         if pos2>length:
-             print "Position",pos2,"out of range"
+             notes.append("Position %s out of range" % pos2)
 
 def valid_strand(strand):
     if not (strand=="+" or strand=="-" or strand=="."):
-        print "Strand should only contain +/-/."
-        sys.exit(1)
+        raise ValidationError("Strand should only contain +/-/.","strand")
     return strand
 
 def is_contain_dot(strand1,strand2):
@@ -126,8 +117,7 @@ def check_float(message):
     try:
         userInput = float(message)
     except ValueError:
-        print "\""+message+"\"" " is not a number or \".\"."
-        sys.exit(1)
+        raise ValidationError("\""+message+"\"" " is not a number or \".\".","quantification")
 
 def check_quantificaton_ok(num):
     if num==".":
@@ -135,40 +125,59 @@ def check_quantificaton_ok(num):
     else:
         check_float(num)
 
-out_data = []
-
-def validate_file(fileName):
+def validate_line(line,table,notes):
+    #the last line of a file may have no line ending
+    tmp=line.rstrip("\r\n").split("\t")
+    if(len(tmp)<10):
+        raise ValidationError("Number of columns of bedpe for fusion should be 10 or 11","columns")
+    chr1,length1=get_target(tmp[0],table)
+    tmp[0]=chr1
+    valid_pos_pair(get_integer(tmp[1]),get_integer(tmp[2]),length1,notes)
+    chr2,length2=get_target(tmp[3],table)
+    tmp[3]=chr2
+    valid_pos_pair(get_integer(tmp[4]),get_integer(tmp[5]),length2,notes)
+    iscd=is_contain_dot(valid_strand(tmp[8]),valid_strand(tmp[9]))
+    if iscd==True:
+        raise ValidationError("Dot not allowed for strand.","strand")
+    #Add check for if quantification column exists
+    if len(tmp) == 11:
+        check_quantificaton_ok(tmp[10])
+    return tmp
+
+def validate_file(fileName,table,notes=None,errors=None,maxErrors=100):
+    """
+    Validates a bedpe file and returns its rows with the target chromosome
+    names. Raises ValidationError at the first invalid row, unless an errors
+    list is given: each invalid row is then skipped and added to it as a
+    dictionary with its 'row' number, 'category' and 'message', and reading
+    stops once the list holds maxErrors entries.
+    """
+    if notes is None:
+        notes=[]
+    out_data=[]
     infile = "%s" % fileName
     f=open(infile,"r")
-    index=0
+    row=0
     while True:
         line=f.readline()
         if line=="":
             break
         else:
-            tmp=line.split("\t")
-            if(len(tmp)<10):
-                print "Number of columns of bedpe for fusion should be 10 or 11"
-                sys.exit(1)
-            tmp[len(tmp)-1] = tmp[len(tmp)-1][0:len(tmp[len(tmp)-1])-1]
-            chr1=get_target(tmp[0])
-            tmp[0]=chr1
-            valid_pos_pair(get_integer(tmp[1]),get_integer(tmp[2]),get_length(chr1))
-            chr2=get_target(tmp[3])
-            tmp[3]=chr2
-            valid_pos_pair(get_integer(tmp[4]),get_integer(tmp[5]),get_length(chr2))
-            iscd=is_contain_dot(valid_strand(tmp[8]),valid_strand(tmp[9]))
-            if iscd==True:
-                print "Dot not allowed for strand."
-                sys.exit(1)
-            #Add check for if quantification column exists
-            if len(tmp) == 11:
-                check_quantificaton_ok(tmp[10])
-            out_data.append(tmp) 
+            row=row+1
+            try:
+                tmp=validate_line(line,table,notes)
+            except ValidationError as e:
+                if errors is None:
+                    raise
+                add_error(errors,row,e)
+                if len(errors)>=maxErrors:
+                    break
+                continue
+            out_data.append(tmp)
     f.close()
+    return out_data
 
-def remove_duplicate():
-    global out_data
+def remove_duplicate(out_data):
     for i in range(len(out_data)):
         pos1=0
         pos2=0
@@ -186,10 +195,7 @@ def remove_duplicate():
         return
     lenRow=len(out_data[0])     
     out_data = sorted(out_data, key = lambda x: (x[0], x[3], x[8], x[9], x[lenRow-2], x[lenRow-1]))
-    out_data_2 = []
     for i in range(len(out_data)):
-        if i==0:
-            out_data_2.append(out_data[i])
         if i>=1:
             if out_data[i][0]==out_data[i-1][0] and out_data[i][3]==out_data[i-1][3] and out_data[i][8]==out_data[i-1][8] and out_data[i][9]==out_data[i-1][9]:
                 delta1=0
@@ -204,19 +210,44 @@ def remove_duplicate():
                 else:
                     delta2 = out_data[i-1][lenRow-1]-out_data[i][lenRow-1]
                 if delta1 ==delta2:
-                    print "line :",out_data[i-1][0],out_data[i-1][1],out_data[i-1][2]," ... and line ",out_data[i][0],out_data[i][1],out_data[i][2]," ... are essentially the same"
-                    sys.exit(1)
+                    raise ValidationError("line : %s %s %s  ... and line  %s %s %s  ... are essentially the same" % (out_data[i-1][0],out_data[i-1][1],out_data[i-1][2],out_data[i][0],out_data[i][1],out_data[i][2]),"duplicate")
+
+def validate_bedpe(chrFile,inFile):
+    """
+    Validates a bedpe file against a chromosome file. Returns the validated
+    rows and the list of messages that did not stop the validation.
+    Raises ValidationError at the first invalid row.
+    """
+    notes=[]
+    table=load_chromosome_table(chrFile)
+    out_data=validate_file(inFile,table,notes)
+    return out_data,notes
 
 def main(argv):
     getParameters(argv[1:])
     if inChrFile=='' or inResFile=='':
         usage()
         return 1        
-    get_valid_name_length(inChrFile)
-    validate_file(inResFile)
-    #remove_duplicate()
+    notes=[]
+    errors=None
+    if maxErrors>0:
+        errors=[]
+    try:
+        table=load_chromosome_table(inChrFile)
+        out_data=validate_file(inResFile,table,notes,errors,maxErrors)
+        #remove_duplicate(out_data)
+    except ValidationError as e:
+        for note in notes:
+            print note
+        print e
+        return 1
+    for note in notes:
+        print note
+    if errors:
+        print_errors(errors,maxErrors)
+        return 1
     print "Validated" 
     return 0
 
 if __name__ == '__main__':
-    sys.exit(main(sys.argv)) 
+    sys.exit(main(sys.argv))
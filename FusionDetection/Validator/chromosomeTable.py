@@ -0,0 +1,61 @@
+#
+# Chromosome name tables shared by the bedpe validators and fix-bedpe.py.
+#
+# A chromosome file has one header line, then one line per target chromosome:
+# target name, length and the comma separated names allowed for it, e.g.
+#   X	155270560	X,chrX,x,ChrX,Chrx
+
+import os
+
+
+class ChromosomeTable(object):
+    """
+    Maps every allowed chromosome name to its target name and length, so a
+    row needs a single dictionary lookup per chromosome. Names are interned
+    and the table only holds plain dictionaries, so it can be pickled.
+    """
+    def __init__(self, targets):
+        self.targets = targets       #allowed name to (target name, length)
+
+    def get(self, name):
+        """Returns (target name, length) for an allowed name or None."""
+        return self.targets.get(name)
+
+    def __contains__(self, name):
+        return name in self.targets
+
+    def __len__(self):
+        return len(self.targets)
+
+
+def read_chromosome_file(fileName):
+    targets = {}
+    f=open(fileName,"r")
+    f.readline()
+    for line in f:
+        tmp=line.rstrip("\r\n").split("\t")
+        if len(tmp)<3:
+            continue
+        target=intern(tmp[0])
+        length=int(tmp[1])
+        for allowed in tmp[2].split(","):
+            if allowed!='':
+                targets[intern(allowed)]=(target,length)
+    f.close()
+    return ChromosomeTable(targets)
+
+
+_tables = {}     #real path to (mtime, ChromosomeTable)
+
+def load_chromosome_table(fileName):
+    """
+    Returns the table of a chromosome file. Each file is read once per
+    process, and again only if it changes on disk.
+    """
+    path=os.path.realpath(fileName)
+    mtime=os.path.getmtime(path)
+    cached=_tables.get(path)
+    if cached is None or cached[0]!=mtime:
+        cached=(mtime,read_chromosome_file(path))
+        _tables[path]=cached
+    return cached[1]
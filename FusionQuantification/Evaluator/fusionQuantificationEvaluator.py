@@ -47,32 +47,25 @@ def string_to_value(message):
     userInput = float(message)
     return userInput
 
+def get_strand_pos(row):
+    pos1=0
+    pos2=0
+    if row[8]=="+":
+        pos1=int(row[2])
+    else:
+        pos1=int(row[1])
+    if row[9]=="+":
+        pos2=int(row[4])
+    else:
+        pos2=int(row[5])
+    return pos1,pos2
+
 def is_same(truth,res):
     if truth[0]!=res[0] or truth[3]!=res[3] or truth[8]!=res[8] or truth[9]!=res[9]:
         return False
     else:
-        tpos1=0
-        tpos2=0
-        if truth[8]=="+":
-            tpos1=int(truth[2])
-        else:
-            tpos1=int(truth[1])
-        if truth[9]=="+":
-            tpos2=int(truth[4])
-        else:
-            tpos2=int(truth[5])
-                
-        rpos1=0
-        rpos2=0
-        if res[8]=="+":
-            rpos1=int(res[2])
-        else:
-            rpos1=int(res[1])
-        if res[9]=="+":
-            rpos2=int(res[4])
-        else:
-            rpos2=int(res[5])
-                
+        tpos1,tpos2=get_strand_pos(truth)
+        rpos1,rpos2=get_strand_pos(res)
         delta1=0
         delta2=0
         if truth[8]=="+":
@@ -87,79 +80,110 @@ def is_same(truth,res):
             return True
     return False
 
-truth_bedpe = []
-
-def load_truth(fileName):
+def load_bedpe(fileName):
     infile = "%s" % fileName
     f=open(infile,"r")
-    index=0
+    rows=[]
     while True:
         line=f.readline()
         if line=="":
             break
         else:
             tmp=line.split("\t")
-            truth_bedpe.append(tmp)
+            rows.append(tmp)
     f.close()
+    return rows
 
-res_bedpe = []
+def load_truth(fileName):
+    return load_bedpe(fileName)
 
 def load_res(fileName):
-    infile = "%s" % fileName
-    f=open(infile,"r")
-    index=0
-    while True:
-        line=f.readline()
-        if line=="":
-            break
-        else:
-            tmp=line.split("\t")
-            res_bedpe.append(tmp)
-    f.close()
-
-res_quantity = []
+    return load_bedpe(fileName)
+
+def get_breakpoint_key(row):
+    #is_same() pairs two rows when delta1==delta2, which is the same as
+    #sign1*pos1-sign2*pos2 being equal for both rows
+    pos1,pos2=get_strand_pos(row)
+    if row[8]=="+":
+        offset=pos1
+    else:
+        offset=-pos1
+    if row[9]=="+":
+        offset=offset-pos2
+    else:
+        offset=offset+pos2
+    return (row[0],row[3],row[8],row[9],offset)
 
-def initial_res_quantity():
+def index_res_quantity(truth_bedpe,res_bedpe):
+    #only rows sharing chromosomes and strands with a truth row can ever match
+    truth_prefix=set()
     for x in range(len(truth_bedpe)):
-        res_quantity.append(0);
-
-def get_res_quantity():
+        tmp=truth_bedpe[x]
+        truth_prefix.add((tmp[0],tmp[3],tmp[8],tmp[9]))
+    res_index={}
+    for y in range(len(res_bedpe)):
+        tmp=res_bedpe[y]
+        if len(tmp)<10 or (tmp[0],tmp[3],tmp[8],tmp[9]) not in truth_prefix:
+            continue
+        #later rows overwrite earlier ones, the last match wins as before
+        res_index[get_breakpoint_key(tmp)]=y
+    return res_index
+
+def get_res_quantity(truth_bedpe,res_bedpe):
+    res_quantity=[0]*len(truth_bedpe)
+    res_index=index_res_quantity(truth_bedpe,res_bedpe)
     for x in range(len(truth_bedpe)):
-        for y in range(len(res_bedpe)):
-            if is_same(truth_bedpe[x],res_bedpe[y]):
-                res_quantity[x]=string_to_value(res_bedpe[y][10])
-                continue
+        y=res_index.get(get_breakpoint_key(truth_bedpe[x]))
+        if y is not None:
+            res_quantity[x]=string_to_value(res_bedpe[y][10])
+    return res_quantity
 
-truth_values = []
-
-def get_truth_values():
+def get_truth_values(truth_bedpe):
+    truth_values=[]
     for x in range(len(truth_bedpe)):
         truth_values.append(string_to_value(truth_bedpe[x][10]))
+    return truth_values
 
 
-def calculateCor():
-    print truth_values,res_quantity
+def calculateCor(truth_values,res_quantity):
     cor,p_value=stats.spearmanr(truth_values,res_quantity)
     final = "spearman\tp-value\n%s\t%s" % (cor,p_value)
-    print(final)
-    return(final)
+    return final,cor,p_value
+
+def score_fusion_rows(truth_bedpe,res_bedpe):
+    """
+    Scores already split bedpe rows. Returns a dictionary with the
+    quantification_result.out text ('cor'), 'spearman', 'p_value' and the
+    paired 'truth_values' and 'res_quantity'.
+    """
+    res_quantity=get_res_quantity(truth_bedpe,res_bedpe)
+    truth_values=get_truth_values(truth_bedpe)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        final,cor,p_value=calculateCor(truth_values,res_quantity)
+    return {'cor': final,
+            'spearman': cor,
+            'p_value': p_value,
+            'truth_values': truth_values,
+            'res_quantity': res_quantity}
+
+def score_fusions(truth,input):
+    """
+    Scores the input bedpe against the truth bedpe, see score_fusion_rows().
+    """
+    return score_fusion_rows(load_truth(truth),load_res(input))
 
 def main(argv):
     getParameters(argv[1:])
     if inTruthFile=='' or inResFile=='':
         usage()
         return 1    
-    load_truth(inTruthFile)
-    load_res(inResFile)
-    initial_res_quantity()
-    get_res_quantity()
-    get_truth_values()
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        final = calculateCor()
-        with open("quantification_result.out",'w') as results:
-            results.write(final)
-            results.close()
+    result = score_fusions(inTruthFile,inResFile)
+    print result['truth_values'],result['res_quantity']
+    print(result['cor'])
+    with open("quantification_result.out",'w') as results:
+        results.write(result['cor'])
+        results.close()
     return(0)
 
 if __name__ == '__main__':
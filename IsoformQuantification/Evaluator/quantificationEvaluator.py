@@ -4,7 +4,9 @@ import sys
 import os
 import math
 import getopt
+import glob
 import warnings
+import multiprocessing
 import numpy
 from collections import Counter 
 from collections import defaultdict
@@ -14,6 +16,7 @@ from scipy.cluster.vq import vq, kmeans2
 def usage():
     print """
     quantificationEvaluator -t <truth-tsv>  -i <input-tsv>
+    quantificationEvaluator -t <truth-tsv>  -m <manifest> / -g <input-glob>  [-p <processes>]
     
     Requested Parameters:
         -t/--truth-tsv         [ string                         path to truth tsv                      ]
@@ -34,8 +37,15 @@ def usage():
                                                                 will only be caculated based on entries
                                                                 with non-zero values in the truth tsv. ]             
         -o/--output            [ string default: ./result       output prefix                          ]
+
+    Batch Parameters (instead of -i, the truth tsv is loaded and stratified once):
+        -m/--manifest          [ string                         file listing one input tsv per line    ]
+        -g/--input-glob        [ string                         glob pattern matching input tsvs       ]
+        -p/--processes         [ int    default: cpu count      number of scoring processes            ]
+                               Writes <output>.<input name>.cor.out/.fdr.out for each input
+                               and all results in <output>.batch.out
  
-    Version:                   1.3.0
+    Version:                   1.4.0
           """
 
 
@@ -45,15 +55,21 @@ inTruthFile = ''                #input truth tsv
 stratify = '1'                  #range separators string
 isBinary = 'no'                 #bin or not bin
 output_prefix = './result'      #output prefix
+inManifest = ''                 #file listing input tsvs, batch mode
+inGlob = ''                     #glob pattern for input tsvs, batch mode
+numProcesses = multiprocessing.cpu_count() #scoring processes, batch mode
 
 def getParameters(argv):
     try:
-        opts, args = getopt.getopt(argv,"ht:i:s:b:o:",["help",
-                                                       "truth-tsv=",
-                                                       "input-tsv=",
-                                                       "stratify=",
-                                                       "isBinary=",
-                                                       "output="])
+        opts, args = getopt.getopt(argv,"ht:i:s:b:o:m:g:p:",["help",
+                                                             "truth-tsv=",
+                                                             "input-tsv=",
+                                                             "stratify=",
+                                                             "isBinary=",
+                                                             "output=",
+                                                             "manifest=",
+                                                             "input-glob=",
+                                                             "processes="])
     except getopt.GetoptError:
         usage()
         sys.exit(1)
@@ -76,23 +92,76 @@ def getParameters(argv):
         elif opt in ("-o","--output"):
             global output_prefix
             output_prefix= arg
+        elif opt in ("-m","--manifest"):
+            global inManifest
+            inManifest = arg
+        elif opt in ("-g","--input-glob"):
+            global inGlob
+            inGlob = arg
+        elif opt in ("-p","--processes"):
+            global numProcesses
+            try:
+                numProcesses = int(arg)
+            except ValueError:
+                numProcesses = 0
+            if numProcesses<1:
+                usage()
+                sys.exit(1)
+
+def countTranscripts(fileName):
+    f=open(fileName,"r")
+    num=0
+    for line in f:
+        if line.startswith("ENST"):
+            num=num+1
+    f.close()
+    return num
 
-input_values_dic = defaultdict(lambda: 0.0)
+def parseRecord(line):
+    #float() ignores the trailing newline, so CRLF and a missing last newline keep every digit
+    tmp=line.split("\t")
+    return tmp[0],float(tmp[1])
 
-def getInputDic():
-    infile = "%s" % inFile
-    f=open(infile,"r")
-    while True:
-        line=f.readline()
-        if line=="":
-            break
-        elif not line.startswith("ENST"):
+def getTruthValues(fileName):
+    """
+    Returns the truth values in file order, the transcript name to row index
+    and the extra rows of names the truth repeats.
+    """
+    truth_all=numpy.empty(countTranscripts(fileName),dtype=numpy.float64)
+    truth_index={}
+    truth_index_dup={}
+    f=open(fileName,"r")
+    row=0
+    for line in f:
+        if not line.startswith("ENST"):
             continue
+        name,value=parseRecord(line)
+        truth_all[row]=value
+        if name in truth_index:
+            truth_index_dup.setdefault(name,[]).append(row)
         else:
-            tmp=line.split("\t")
-            name=tmp[0]
-            value=float(tmp[1][0:len(tmp[1])-1])
-            input_values_dic[name]=value
+            truth_index[name]=row
+        row=row+1
+    f.close()
+    return truth_all,truth_index,truth_index_dup
+
+def readRecords(fileName):
+    f=open(fileName,"r")
+    for line in f:
+        if line.startswith("ENST"):
+            yield parseRecord(line)
+    f.close()
+
+def getInputValues(records,truth_index,truth_index_dup,num):
+    #transcripts missing from the input count as 0.0, those missing from the truth are ignored
+    input_all=numpy.zeros(num,dtype=numpy.float64)
+    for name,value in records:
+        row=truth_index.get(name)
+        if row is not None:
+            input_all[row]=value
+            for dup in truth_index_dup.get(name,[]):
+                input_all[dup]=value
+    return input_all
 
 def checkIsBinary():
     global isBinary
@@ -105,43 +174,8 @@ def checkIsBinary():
             print "--binary: must be yes or no."
             exit(1)
 
-truth_values_zero = []
-input_values_zero = []
-
-truth_values = []
-input_values = []
-
-def getBothValues():
-    infile = "%s" % inTruthFile
-    f=open(infile,"r")
-    while True:
-        line=f.readline()
-        if line=="":
-            break
-        elif not line.startswith("ENST"):
-            continue
-        else:
-            tmp=line.split("\t")
-            name=tmp[0]
-            value=float(tmp[1][0:len(tmp[1])-1])
-            if isBinary != 'no' and value ==0.0:
-                truth_values_zero.append(0.0)
-            else:
-                truth_values.append(value)
-            if input_values_dic.get(name) is not None:
-                if isBinary != 'no' and value ==0.0:
-                    input_values_zero.append(input_values_dic[name])
-                else:
-                    input_values.append(input_values_dic[name])
-            else:
-                if isBinary != 'no' and value ==0.0:
-                    input_values_zero.append(0.0)
-                else:
-                    input_values.append(0.0)
-
-
-def percentToValues(percents):
-    tmp_values=sorted(truth_values)
+def percentToValues(percents,truth_values):
+    tmp_values=numpy.sort(truth_values).tolist()
     tmp_res = []
     if (max(percents)<1):
         print "warning!"
@@ -149,60 +183,53 @@ def percentToValues(percents):
     percents.sort()
     for x in range(len(percents)):
         if percents[x]<0.0 or percents[x]>=100.0:
-            print "-s: "+str(percents[x])+" out of range"
-            exit(1)
+            raise ValueError("-s: "+str(percents[x])+" out of range")
         index=int(len(tmp_values)*(percents[x]/100))
         if(index+1<len(tmp_values)):
             index=index+1
         tmp_res.append(tmp_values[index])
     return tmp_res
 
-num_class = 0
-separators = []
-
-def parseSratify():
+def parseSratify(stratify,truth_values):
+    """
+    Returns the number of classes and the separators for a -s string.
+    Raises ValueError if the string is not valid.
+    """
     num=stratify.count(":")
-    global num_class
-    global separators
+    num_class=0
+    separators=[]
     if num==0:
         num_class=int(stratify)
     if num>0:
         tmp=stratify.split(":")
         num_class=int(tmp[0])
         if num_class==1:
-            print "number of class is 1, no need to set separators"
-            exit(1)
+            raise ValueError("number of class is 1, no need to set separators")
     if num_class>1:
             if num>0 and len(tmp[1].split(","))!=num_class-1:
-                print "number of separators not matching number of classes"
-                exit(1)
+                raise ValueError("number of separators not matching number of classes")
             if num==0:
                 pct=[]
                 for x in range(num_class):
                     if x!=0:
                         pct.append(float(x)/num_class*100)
-                separators=percentToValues(pct)
+                separators=percentToValues(pct,truth_values)
             if num==1:
                 tmp=stratify.split(":")
-                separators=percentToValues(map(float,tmp[1].split(",")))
+                separators=percentToValues(map(float,tmp[1].split(",")),truth_values)
             if num==2:
                 tmp=stratify.split(":")
                 if tmp[2]!='v':
-                    print "check input -s the third value after : has to be v"
-                    exit(1)
+                    raise ValueError("check input -s the third value after : has to be v")
                 else:
                     print "You are using values instead of percent" 
                 separators=map(float,tmp[1].split(","))
+    return num_class,separators
 
-srangeL = []
-srangeR = []
-
-def getStratifiedRanges():
-    global separators
-    srangeL.append(0.0)
-    srangeR.append(float('inf'))
+def getStratifiedRanges(num_class,separators):
+    srangeL = [0.0]
+    srangeR = [float('inf')]
     vs = []
-    global num_class
     if num_class>1:    
         srangeL.append(0.0)
         for x in range(len(separators)):
@@ -212,102 +239,256 @@ def getStratifiedRanges():
             srangeL.append(vs[x])
             srangeR.append(vs[x])
         srangeR.append(float('inf'))
+    return srangeL,srangeR
 
-def valueToRangeId(v):
-    for x in range(len(srangeL)):
-        if x>0 and v >=srangeL[x] and v<srangeR[x]:
-            return x 
+def valuesToRangeIds(values,srangeR):
+    #range x>0 holds srangeL[x] <= v < srangeR[x], found by binary search on the separators
+    ids=numpy.searchsorted(numpy.array(srangeR[1:-1],dtype=numpy.float64),values,side='right')+1
+    ids[(values<0.0) | numpy.isinf(values)]=0
+    return ids
 
-truth_values_vec = []
-input_values_vec = []
+def getStratumMasks(truth_values,srangeL,srangeR):
+    stratum_masks = []
+    if len(srangeL)>1:
+        sids=valuesToRangeIds(numpy.asarray(truth_values,dtype=numpy.float64),srangeR)
+        for x in range(1,len(srangeL)):
+            stratum_masks.append(sids==x)
+    return stratum_masks
 
-def getBothStrafiedVectors():
-    for x in range(len(srangeL)):
-        truth_values_vec.append([])
-        input_values_vec.append([])
-    for x in range(len(truth_values)):
-        sid=valueToRangeId(truth_values[x])    
-        truth_values_vec[0].append(truth_values[x])
-        input_values_vec[0].append(input_values[x])
-        if len(srangeL)>1:
-            truth_values_vec[sid].append(truth_values[x])
-            input_values_vec[sid].append(input_values[x])
-
-def printBinary():
-    ofstring = 'off'
-    if isBinary!='no':
-        ofstring = 'on'
-    print "Binning zero and non-zero values: "+ofstring+"\n"
-
-def printStratify():
-    print "The stratification used is: -s "+stratify
-    print "The separators are:         ",' '.join(map(str, separators))
-    print
-
-def printValues():
-    for x in range(len(srangeL)):
-        print "range "+str(x)+":\t"+str(srangeL[x])+" - "+str(srangeR[x])+":"
-        print "Truth:\t\t",' '.join(map(str, truth_values_vec[x]))
-        print "Input:\t\t",' '.join(map(str, input_values_vec[x]))
-        print
+def getBothStrafiedVectors(truth_values,input_values,stratum_masks):
+    truth=numpy.asarray(truth_values,dtype=numpy.float64)
+    inputs=numpy.asarray(input_values,dtype=numpy.float64)
+    truth_values_vec=[truth]
+    input_values_vec=[inputs]
+    for mask in stratum_masks:
+        truth_values_vec.append(truth[mask])
+        input_values_vec.append(inputs[mask])
+    return truth_values_vec,input_values_vec
 
-def calculateCor():
+def calculateCor(truth_values_vec,input_values_vec,srangeL,srangeR,isBinary):
+    """
+    Returns the .cor.out text, the table printed to the console and the
+    (range, spearman, pearson, log_pearson) rows they are made of.
+    """
     final  = "range\tspearman\tpearson\tlog_pearson"
     final2 = "range\t\t\tspearman\tpearson\t\tlog_pearson"
+    rows = []
     for x in range(len(srangeL)):
         cor,p_value=stats.spearmanr(truth_values_vec[x],input_values_vec[x])
         pearson,pearson_pvalue=stats.pearsonr(truth_values_vec[x],input_values_vec[x])
         log_pearson,log_pearson_pvalue=stats.pearsonr(numpy.log(numpy.add(truth_values_vec[x],0.01)),numpy.log(numpy.add(input_values_vec[x],0.01)))
         if isBinary != 'no' and x<=1:
-            tmp  = "\n(%s,%s)\t%s\t%s\t%s" % (srangeL[x],srangeR[x],cor,pearson,log_pearson)
+            srange = "(%s,%s)" % (srangeL[x],srangeR[x])
             tmp2 = "\n(%.3f,%.3f)\t\t%.3f\t\t%.3f\t\t%.3f" % (srangeL[x],srangeR[x],cor,pearson,log_pearson)        
         else:
-            tmp  = "\n[%s,%s)\t%s\t%s\t%s" % (srangeL[x],srangeR[x],cor,pearson,log_pearson)
+            srange = "[%s,%s)" % (srangeL[x],srangeR[x])
             tmp2 = "\n[%.3f,%.3f)\t\t%.3f\t\t%.3f\t\t%.3f" % (srangeL[x],srangeR[x],cor,pearson,log_pearson)
+        tmp  = "\n%s\t%s\t%s\t%s" % (srange,cor,pearson,log_pearson)
+        rows.append((srange,cor,pearson,log_pearson))
         final  = final  + tmp
         final2 = final2 + tmp2
         if x==0 and len(srangeL)!=1:
             final2=final2+"\n"
-    print(final2)
-    print
-    return(final)
+    return final,final2,rows
 
-def calculateFDR():
+def calculateFDR(truth_values_zero,input_values_zero):
+    """
+    Returns the .fdr.out text and the FDR value.
+    """
     final = "FDR:\t"
     total_zero_num=len(truth_values_zero)
-    input_zero_num=0
-    for x in range(len(input_values_zero)):
-        if input_values_zero[x]!=0.0:
-            input_zero_num=input_zero_num+1
-    fdr_str = str(numpy.float32(input_zero_num)/float(total_zero_num))
-    final = final + fdr_str
+    input_zero_num=numpy.count_nonzero(input_values_zero!=0.0)
+    fdr=numpy.float32(input_zero_num)/float(total_zero_num)
+    final = final + str(fdr)
+    return final,fdr
+
+class StratifiedTruth(object):
+    """
+    A truth tsv loaded, split for --binary and stratified once, so that any
+    number of input tsvs can be scored against it.
+    """
+    def __init__(self, truthFile, stratify='1', isBinary='no'):
+        self.stratify = stratify
+        self.isBinary = isBinary
+        self.truth_all, self.truth_index, self.truth_index_dup = getTruthValues(truthFile)
+        self.truth_zero = numpy.zeros(len(self.truth_all),dtype=bool)
+        if isBinary != 'no':
+            self.truth_zero = (self.truth_all==0.0)
+        self.truth_values_zero = self.truth_all[self.truth_zero]
+        self.truth_values = self.truth_all[~self.truth_zero]
+        self.num_class, self.separators = parseSratify(stratify,self.truth_values)
+        self.srangeL, self.srangeR = getStratifiedRanges(self.num_class,self.separators)
+        self.stratum_masks = getStratumMasks(self.truth_values,self.srangeL,self.srangeR)
+
+    def score(self, inputFile):
+        """
+        Scores one input tsv. Returns a dictionary with the .cor.out and
+        .fdr.out texts ('cor', 'fdr'), the console table ('cor_table'), the
+        correlations per range ('ranges'), the FDR value ('fdr_value') and the
+        stratified vectors ('truth_values_vec', 'input_values_vec').
+        """
+        return self.scoreRecords(readRecords(inputFile))
+
+    def scoreRecords(self, records):
+        """
+        Scores (name, value) pairs that were already parsed, see score().
+        """
+        input_all = getInputValues(records,self.truth_index,self.truth_index_dup,len(self.truth_all))
+        input_values_zero = input_all[self.truth_zero]
+        input_values = input_all[~self.truth_zero]
+        truth_values_vec,input_values_vec = getBothStrafiedVectors(self.truth_values,input_values,self.stratum_masks)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            final,final2,rows = calculateCor(truth_values_vec,input_values_vec,self.srangeL,self.srangeR,self.isBinary)
+            final_fdr,fdr = calculateFDR(self.truth_values_zero,input_values_zero)
+        return {'cor': final,
+                'cor_table': final2,
+                'ranges': rows,
+                'fdr': final_fdr,
+                'fdr_value': fdr,
+                'truth_values_vec': truth_values_vec,
+                'input_values_vec': input_values_vec}
+
+def score_isoforms(truth, input, stratify='1', binary='no'):
+    """
+    Scores the input tsv against the truth tsv, see StratifiedTruth.score().
+    Raises ValueError if the stratify string is not valid.
+    """
+    return StratifiedTruth(truth, stratify, binary).score(input)
+
+def printBinary(isBinary):
+    ofstring = 'off'
+    if isBinary!='no':
+        ofstring = 'on'
+    print "Binning zero and non-zero values: "+ofstring+"\n"
+
+def printStratify(stratify,separators):
+    print "The stratification used is: -s "+stratify
+    print "The separators are:         ",' '.join(map(str, separators))
+    print
+
+def printValues(truth,result):
+    for x in range(len(truth.srangeL)):
+        print "range "+str(x)+":\t"+str(truth.srangeL[x])+" - "+str(truth.srangeR[x])+":"
+        print "Truth:\t\t",' '.join(map(str, result['truth_values_vec'][x].tolist()))
+        print "Input:\t\t",' '.join(map(str, result['input_values_vec'][x].tolist()))
+        print
+
+def printResult(result):
+    print(result['cor_table'])
+    print
+    print
+    print result['fdr']
+
+def writeResults(prefix,final,final_fdr):
+    with open(prefix+".cor.out",'w') as results:
+        results.write(final)
+        results.close()
+    with open(prefix+".fdr.out",'w') as results:
+        results.write(final_fdr)
+        results.close()
+
+def getBatchInputs():
+    inputs=[]
+    if inManifest!='':
+        f=open(inManifest,"r")
+        for line in f:
+            line=line.strip()
+            if line!='' and not line.startswith("#"):
+                inputs.append(line)
+        f.close()
+    if inGlob!='':
+        inputs.extend(sorted(glob.glob(inGlob)))
+    return inputs
+
+def getBatchPrefixes(inputs):
+    prefixes=[]
+    used=set()
+    for x in range(len(inputs)):
+        name=os.path.splitext(os.path.basename(inputs[x]))[0]
+        if name in used:
+            name=name+"."+str(x)
+        used.add(name)
+        prefixes.append(output_prefix+"."+name)
+    return prefixes
+
+batch_truth = None             #StratifiedTruth shared with the batch workers
+
+def silenceWorker():
+    sys.stdout=open(os.devnull,"w")
+
+def scoreInput(job):
+    #runs in a forked worker, batch_truth is inherited from the parent
+    inputFile,prefix=job
+    try:
+        result=batch_truth.score(inputFile)
+        writeResults(prefix,result['cor'],result['fdr'])
+    except Exception as e:
+        return (inputFile,None,"%s: %s" % (type(e).__name__,e))
+    return (inputFile,result['cor'],result['fdr'])
+
+def writeBatchTable(scores):
+    f=open(output_prefix+".batch.out","w")
+    f.write("input\trange\tspearman\tpearson\tlog_pearson\tFDR\n")
+    for name,final,final_fdr in scores:
+        if final is None:
+            #the message goes in the spearman column, on one line and padded to the header
+            message=" ".join(final_fdr.split())
+            f.write("%s\terror\t%s\t\t\t\n" % (name,message))
+            continue
+        fdr=final_fdr.split("\t")[1]
+        for line in final.split("\n")[1:]:
+            f.write("%s\t%s\t%s\n" % (name,line,fdr))
+    f.close()
+
+def batchMain(truth):
+    global batch_truth
+    inputs=getBatchInputs()
+    if len(inputs)==0:
+        print "No input tsv found in the manifest or glob."
+        return 1
+    batch_truth=truth
+    pool=multiprocessing.Pool(processes=max(1,min(numProcesses,len(inputs))),initializer=silenceWorker)
+    try:
+        scores=pool.map(scoreInput,zip(inputs,getBatchPrefixes(inputs)))
+    finally:
+        pool.close()
+        pool.join()
+    writeBatchTable(scores)
+    failed=0
+    for name,final,final_fdr in scores:
+        if final is None:
+            print "failed:",name,final_fdr
+            failed=failed+1
+        else:
+            print "scored:",name,final_fdr.replace("\t"," ")
+    print "Wrote",len(scores)-failed,"of",len(scores),"results to",output_prefix+".batch.out"
     print
-    print final
-    return final
+    printBinary(isBinary)
+    printStratify(stratify,truth.separators)
+    if failed>0:
+        return 1
+    return(0)
 
 def main(argv):
     getParameters(argv[1:])
-    if inFile=='' or inTruthFile=='':
+    isBatch = inManifest!='' or inGlob!=''
+    if inTruthFile=='' or (inFile=='' and not isBatch) or (inFile!='' and isBatch):
         usage()
         return 1
-    getInputDic()
-    getBothValues()
-    parseSratify() 
-    getStratifiedRanges()
-    getBothStrafiedVectors()
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        final = calculateCor()
-        final_fdr = calculateFDR()
-        with open(output_prefix+".cor.out",'w') as results:
-            results.write(final)
-            results.close()
-        with open(output_prefix+".fdr.out",'w') as results:
-            results.write(final_fdr)
-            results.close()
-    printBinary()
-    printStratify()
-    printValues()
+    try:
+        truth = StratifiedTruth(inTruthFile, stratify, isBinary)
+    except ValueError as e:
+        print e
+        return 1
+    if isBatch:
+        return batchMain(truth)
+    result = truth.score(inFile)
+    printResult(result)
+    writeResults(output_prefix,result['cor'],result['fdr'])
+    printBinary(isBinary)
+    printStratify(stratify,truth.separators)
+    printValues(truth,result)
     return(0)
     
 if __name__ == '__main__':
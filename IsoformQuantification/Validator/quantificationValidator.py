@@ -4,6 +4,7 @@ import sys
 import os
 import math
 import getopt
+import tempfile
 from collections import Counter 
 from collections import defaultdict
 
@@ -15,19 +16,33 @@ def usage():
         -g/--gene-model-gtf    [string:    path to gene model gtf ]
         -i/--input-tsv         [string:    path to input tsv      ]
 
-    Version:                    1.0.0
+    Optional Parameters:
+        -e/--max-errors        [int. Default: 0  Report up to this many invalid rows]
+                               [instead of stopping at the first one               ]
+        -m/--check-model       [Change to True. Default: False  Transcripts must be ]
+                               [in the gene model                                   ]
+        -x/--index-file        [string:    path to transcript index of the gtf      ]
+                               [Default: <gene-model-gtf>.transcripts               ]
+
+    Version:                    1.2.0
           """
 
 
 #parameters
 inFile = ''               #input tsv
 geneModel = ''           #gene model gtf
+maxErrors = 0             #If >0, reports up to this many invalid rows
+checkModel = False        #If True, transcripts must be in the gene model
+indexFile = ''            #transcript index of the gene model
 
 def getParameters(argv):
     try:
-        opts, args = getopt.getopt(argv,"hg:i:",["help",
+        opts, args = getopt.getopt(argv,"hg:i:e:mx:",["help",
                                                  "gene-model-gtf=",
-                                                 "input-tsv="])
+                                                 "input-tsv=",
+                                                 "max-errors=",
+                                                 "check-model",
+                                                 "index-file="])
     except getopt.GetoptError:
         usage()
         sys.exit(1)
@@ -41,12 +56,35 @@ def getParameters(argv):
         elif opt in ("-g","--gene-model-gtf"):
             global geneModel
             geneModel = arg
+        elif opt in ("-e","--max-errors"):
+            global maxErrors
+            maxErrors = int(arg)
+        elif opt in ("-m","--check-model"):
+            global checkModel
+            checkModel = True
+        elif opt in ("-x","--index-file"):
+            global indexFile
+            indexFile = arg
+
+
 
+class ValidationError(Exception):
+    def __init__(self, message, category='invalid'):
+        Exception.__init__(self, message)
+        self.category = category      #kind of check that failed, for reports
 
+def add_error(errors,row,error):
+    errors.append({'row': row, 'category': error.category, 'message': str(error)})
 
-transcripts_in_model = defaultdict(lambda: 'badTranscriptName')
+def print_errors(errors,maxErrors):
+    print "row\tcategory\tmessage"
+    for error in errors:
+        print "%d\t%s\t%s" % (error['row'],error['category'],error['message'])
+    if len(errors)>=maxErrors:
+        print "Stopped after %d errors." % maxErrors
 
-def getAllTranscriptNames():
+def getAllTranscriptNames(geneModel):
+    transcripts_in_model = set()
     infile = "%s" % geneModel
     f=open(infile,"r")
     while True:
@@ -62,57 +100,171 @@ def getAllTranscriptNames():
             tmp3=tmp2[3].split(";")
             tmp4=tmp3[0]
             name = tmp4.replace("\"","")
-            transcripts_in_model[name]='transcript'
+            transcripts_in_model.add(name)
+    f.close()
+    return transcripts_in_model
 
-def isFloat(message):
+def getGeneModelStamp(geneModel):
+    #the gtf is too large to hash on every run, its path, size and mtime
+    #tell whether an index was built from it
+    path=os.path.realpath(geneModel)
+    st=os.stat(path)
+    return "%s\t%d\t%d" % (path,st.st_size,int(st.st_mtime))
+
+def getIndexFiles(geneModel,indexFile=''):
+    if indexFile!='':
+        return [indexFile]
+    #fall back to the temp dir when the gtf sits in a read-only directory
+    name=os.path.basename(geneModel)+".transcripts"
+    return [geneModel+".transcripts",
+            os.path.join(tempfile.gettempdir(),"%x.%s" % (abs(hash(os.path.realpath(geneModel))),name))]
+
+def readTranscriptIndex(fileName,stamp):
+    """
+    Returns the transcript names stored in an index file, or None if it is
+    missing or was built from another version of the gtf.
+    """
+    try:
+        f=open(fileName,"r")
+    except IOError:
+        return None
+    if f.readline()!="#"+stamp+"\n":
+        f.close()
+        return None
+    transcripts_in_model=set(f.read().split("\n"))
+    transcripts_in_model.discard("")
+    f.close()
+    return transcripts_in_model
+
+def writeTranscriptIndex(fileName,stamp,transcripts_in_model):
+    #written next to the index then renamed, so a concurrent run never
+    #reads a partial index
+    try:
+        fd,tmpName=tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fileName)))
+        f=os.fdopen(fd,"w")
+        f.write("#"+stamp+"\n")
+        f.write("\n".join(sorted(transcripts_in_model)))
+        f.write("\n")
+        f.close()
+        os.rename(tmpName,fileName)
+    except (IOError,OSError):
+        return False
+    return True
+
+def loadTranscriptNames(geneModel,indexFile=''):
+    """
+    Returns the transcript names of a gene model gtf. The gtf is scanned once,
+    later runs read the names from its index file while the gtf is unchanged.
+    """
+    stamp=getGeneModelStamp(geneModel)
+    fileNames=getIndexFiles(geneModel,indexFile)
+    for fileName in fileNames:
+        transcripts_in_model=readTranscriptIndex(fileName,stamp)
+        if transcripts_in_model is not None:
+            return transcripts_in_model
+    transcripts_in_model=getAllTranscriptNames(geneModel)
+    for fileName in fileNames:
+        if writeTranscriptIndex(fileName,stamp,transcripts_in_model):
+            break
+    return transcripts_in_model
+
+def getFloat(message):
     try:
         userInput = float(message)
     except ValueError:
         message=message[0:len(message)-1]
-        print "The value \""+message+"\"" " is not number."
-        sys.exit(1)
+        raise ValidationError("The value \""+message+"\"" " is not number.","value")
+    return userInput
+
+def isFloat(message):
+    getFloat(message)
     return True
 
-transcripts_used = defaultdict(lambda: 0)
+def validRecord(line,transcripts_used,transcripts_in_model=None):
+    tmp=line.split("\t")
+    line=line[0:len(line)-1]
+    if len(tmp)!=2:
+        line=line[0:len(line)-1]
+        raise ValidationError("Line with not 2 fields: >>>>  %s  <<<<." % line,"columns")
+    name=tmp[0]
+    value=tmp[1]
+    if transcripts_in_model is not None and name not in transcripts_in_model:
+        raise ValidationError("Transcript name: >>>>  %s  <<<< not from gene model." % name,"transcript")
+    if name in transcripts_used:
+        raise ValidationError("Repeat transcript: >>>> %s  <<<<." % name,"duplicate")
+    value=getFloat(value)
+    transcripts_used.add(name)
+    return name,value
 
-def valideRecord():
+def validRecords(inFile,transcripts_in_model=None,errors=None,maxErrors=100):
+    """
+    Yields the (name, value) of each transcript row of an isoform
+    quantification tsv once it is validated, raises ValidationError at the
+    first invalid row. Transcripts are checked against transcripts_in_model
+    unless it is None. If an errors list is given, invalid rows are skipped
+    and added to it as dictionaries with their 'row' number, 'category' and
+    'message' instead, until it holds maxErrors entries.
+    """
+    transcripts_used = set()
     infile = "%s" % inFile
     f=open(infile,"r")
+    row=0
     #ignore all headers
     while True:
         line=f.readline()
         if line=="":
             break
-        elif not line.startswith("ENST"):
+        row=row+1
+        if not line.startswith("ENST"):
             continue
         else:
-            tmp=line.split("\t")
-            line=line[0:len(line)-1]
-            if len(tmp)!=2:
-                line=line[0:len(line)-1]
-                print "Line with not 2 fields: >>>> ", line, " <<<<.",
-                sys.exit(1)
-            name=tmp[0]
-            value=tmp[1]
-            #if transcripts_in_model[name]!='transcript':
-            #    print "Transcript name: >>>> ",name," <<<< not from gene model."
-            #    sys.exit(1)
-            if transcripts_used[name]>0:
-                print "Repeat transcript: >>>>",name," <<<<."
-                sys.exit(1)
-            if isFloat(value):
-                transcripts_used[name]=1
+            try:
+                yield validRecord(line,transcripts_used,transcripts_in_model)
+            except ValidationError as e:
+                if errors is None:
+                    raise
+                add_error(errors,row,e)
+                if len(errors)>=maxErrors:
+                    break
+    f.close()
+
+def valideRecord(inFile,transcripts_in_model=None,errors=None,maxErrors=100):
+    """
+    Validates an isoform quantification tsv, raises ValidationError at the
+    first invalid row, or collects the errors as validRecords() does.
+    """
+    for record in validRecords(inFile,transcripts_in_model,errors,maxErrors):
+        pass
+
+def validate_quantification(geneModel,inFile,errors=None,maxErrors=100,checkModel=False,indexFile=''):
+    """
+    Validates an isoform quantification tsv, against the transcripts of a
+    gene model gtf if checkModel is True. Raises ValidationError at the first
+    invalid row, or collects the errors as validRecords() does.
+    """
+    transcripts_in_model = None
+    if checkModel:
+        transcripts_in_model = loadTranscriptNames(geneModel,indexFile)
+    valideRecord(inFile,transcripts_in_model,errors,maxErrors)
 
 def main(argv):
     getParameters(argv[1:])
     if inFile=='' or geneModel=='':
         usage()
         return 1
-    getAllTranscriptNames()
-    valideRecord()
+    errors=None
+    if maxErrors>0:
+        errors=[]
+    try:
+        validate_quantification(geneModel,inFile,errors,maxErrors,checkModel,indexFile)
+    except ValidationError as e:
+        print e
+        return 1
+    if errors:
+        print_errors(errors,maxErrors)
+        return 1
     print "Validated"
     return 0
 
 if __name__ == '__main__':
     sys.exit(main(sys.argv))
-
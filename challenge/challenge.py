@@ -31,8 +31,11 @@ from synapseclient.annotations import from_submission_status_annotations
 from collections import OrderedDict
 from datetime import datetime, timedelta
 from itertools import izip
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 from StringIO import StringIO
 import copy
+import hashlib
 
 import argparse
 import lock
@@ -44,6 +47,7 @@ import re
 import sys
 import tarfile
 import tempfile
+import threading
 import time
 import traceback
 import urllib
@@ -60,6 +64,7 @@ except Exception as ex1:
     raise ex1
 
 import messages
+import namecache
 
 
 # the batch size can be bigger, we do this just to demonstrate batching
@@ -68,11 +73,50 @@ BATCH_SIZE = 20
 # how many times to we retry batch uploads of submission annotations
 BATCH_UPLOAD_RETRY_COUNT = 5
 
+# wait between retries of a batch upload, in seconds, doubled on each retry
+BATCH_UPLOAD_BACKOFF = 1
+BATCH_UPLOAD_MAX_BACKOFF = 60
+
+# give up uploading the remaining statuses after this many seconds
+BATCH_UPLOAD_TIMEOUT = 15 * 60
+
+# HTTP status codes of failed batch uploads worth retrying
+BATCH_UPLOAD_RETRY_CODES = set([429, 500, 502, 503, 504])
+
+# a ConflictingUpdateException, another series of batches took over and the
+# upload starts again from the first batch
+BATCH_UPLOAD_CONFLICT_CODE = 412
+
+# how many submissions are downloaded and validated at the same time
+VALIDATION_WORKERS = 4
+
+# how many leaderboard rows are inserted or updated in one rowset
+LEADERBOARD_BATCH_SIZE = 100
+
+# how many rows a Query asks for at a time
+QUERY_PAGE_SIZE = 100
+
+# archive() keeps track of what it has archived in this file, per evaluation
+ARCHIVE_MANIFEST = 'archive.%s.manifest.json'
+
+# table mapping the synData index files to their copy in the bucket,
+# rows are appended this many at a time
+ARCHIVE_MAPPING_TABLE = "syn7348150"
+ARCHIVE_MAPPING_BATCH_SIZE = 50
+
 UUID_REGEX = re.compile('[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}')
 
 # A module level variable to hold the Synapse connection
 syn = None
 
+# Locks of the phases of the scoring script are refreshed every
+# lock.LOCK_DEFAULT_HEARTBEAT and broken if they haven't been for LOCK_MAX_AGE
+LOCK_MAX_AGE = timedelta(minutes=10)
+
+# Cache of user and team names, see namecache.py
+name_cache = None
+NAME_CACHE_FILE = 'challenge.names.sqlite'
+
 
 def to_column_objects(leaderboard_columns):
     """
@@ -94,53 +138,157 @@ def get_user_name(profile):
     return " ".join(names)
 
 
+def cached_name(key, fetch):
+    if name_cache is None:
+        return fetch()
+    return name_cache.get(key, fetch)
+
+
+def get_user_name_by_id(userId):
+    """Name of a user, looked up in the name cache first"""
+    return cached_name('user/%s' % userId, lambda: get_user_name(syn.getUserProfile(userId)))
+
+
+def get_team_name(teamId):
+    """Name of a team, or its ID if it has none, looked up in the name cache first"""
+    def fetch():
+        team = syn.restGET('/team/{id}'.format(id=teamId))
+        return team['name'] if 'name' in team else teamId
+    return cached_name('team/%s' % teamId, fetch)
+
+
 def update_submissions_status_batch(evaluation, statuses):
     """
     Update statuses in batch. This can be much faster than individual updates,
     especially in rank based scoring methods which recalculate scores for all
     submissions each time a new submission is received.
-    """
 
-    for retry in range(BATCH_UPLOAD_RETRY_COUNT):
+    A failed batch is retried from the token of the last batch written, after
+    a jittered exponential backoff and with half as many statuses, so that a
+    status that can't be written ends up alone in its batch. Such a status is
+    skipped after BATCH_UPLOAD_RETRY_COUNT retries, and the upload stops after
+    BATCH_UPLOAD_TIMEOUT seconds. A conflict with another series of batches
+    restarts the upload from the first batch.
+
+    Synapse only commits a series once its last batch is written, so the
+    first and last batch are worked out from the statuses still to be sent,
+    and a series whose last statuses were skipped is closed by an empty
+    batch. If the series can't be closed, none of its statuses are written.
+
+    :returns: the statuses that were not written
+    """
+    unwritten = []
+    pending = list(statuses)
+    deadline = time.time() + BATCH_UPLOAD_TIMEOUT
+    batch_size = BATCH_SIZE
+    failures = 0
+    conflicts = 0
+    token = None
+    offset = 0
+    closed = False
+    while offset < len(pending) or (offset > 0 and not closed):
+        if time.time() > deadline:
+            sys.stderr.write('Timed out uploading statuses of evaluation %s\n' % evaluation.id)
+            unwritten.extend(pending)
+            break
+        batch = {"statuses"     : pending[offset:offset+batch_size],
+                 "isFirstBatch" : (offset==0),
+                 "isLastBatch"  : (offset+batch_size>=len(pending)),
+                 "batchToken"   : token}
         try:
-            token = None
-            offset = 0
-            while offset < len(statuses):
-                batch = {"statuses"     : statuses[offset:offset+BATCH_SIZE],
-                         "isFirstBatch" : (offset==0),
-                         "isLastBatch"  : (offset+BATCH_SIZE>=len(statuses)),
-                         "batchToken"   : token}
-                response = syn.restPUT("/evaluation/%s/statusBatch" % evaluation.id, json.dumps(batch))
-                token = response.get('nextUploadToken', None)
-                offset += BATCH_SIZE
-        except SynapseHTTPError as err:
-            # on 412 ConflictingUpdateException we want to retry
-            if err.response.status_code == 412:
-                # sys.stderr.write('%s, retrying...\n' % err.message)
-                time.sleep(2)
-            else:
-                raise
+            response = syn.restPUT("/evaluation/%s/statusBatch" % evaluation.id, json.dumps(batch))
+        except (SynapseHTTPError, IOError) as err:
+            status_code = getattr(err.response, 'status_code', None) if isinstance(err, SynapseHTTPError) else None
+            sys.stderr.write('Error uploading %d statuses of evaluation %s: %s\n' % (len(batch['statuses']), evaluation.id, err))
+            if status_code == BATCH_UPLOAD_CONFLICT_CODE:
+                conflicts += 1
+                if conflicts > BATCH_UPLOAD_RETRY_COUNT:
+                    unwritten.extend(pending)
+                    break
+                ## start a new series
+                token = None
+                offset = 0
+                batch_size = BATCH_SIZE
+                failures = 0
+                time.sleep(random.uniform(0, min(BATCH_UPLOAD_MAX_BACKOFF, BATCH_UPLOAD_BACKOFF * 2**conflicts)))
+                continue
+            retry = status_code is None or status_code in BATCH_UPLOAD_RETRY_CODES
+            if len(batch['statuses']) > 1:
+                batch_size = len(batch['statuses']) // 2
+            elif not retry or failures >= BATCH_UPLOAD_RETRY_COUNT:
+                if not batch['statuses']:
+                    ## the series can't be closed
+                    unwritten.extend(pending)
+                    break
+                ## skip the status that keeps failing, the batches after it
+                ## are numbered from the statuses that are left
+                unwritten.append(pending.pop(offset))
+                failures = 0
+                continue
+            if retry:
+                failures += 1
+                time.sleep(random.uniform(0, min(BATCH_UPLOAD_MAX_BACKOFF, BATCH_UPLOAD_BACKOFF * 2**failures)))
+            continue
+        token = response.get('nextUploadToken', None)
+        offset += len(batch['statuses'])
+        closed = batch['isLastBatch']
+        failures = 0
+        batch_size = min(BATCH_SIZE, batch_size * 2)
+
+    if len(unwritten) > 0:
+        sys.stderr.write('Statuses not written for submissions: %s\n' % ", ".join(str(status.id) for status in unwritten))
+    return unwritten
 
 
 class Query(object):
     """
     An object that helps with paging through annotation query results.
 
+    Pages of limit rows are requested one ahead: while the rows of a page are
+    handed out, a background thread fetches the next one.
+
     Also exposes properties totalNumberOfResults, headers and rows.
     """
-    def __init__(self, query, limit=20, offset=0):
+    def __init__(self, query, limit=QUERY_PAGE_SIZE, offset=0, prefetch=True):
         self.query = query
         self.limit = limit
         self.offset = offset
+        self.prefetch = prefetch
+        self.next_page = None
         self.fetch_batch_of_results()
 
+    def get_page(self, offset):
+        uri = "/evaluation/submission/query?query=" + urllib.quote_plus("%s limit %s offset %s" % (self.query, self.limit, offset))
+        return syn.restGET(uri)
+
+    def prefetch_page(self, offset):
+        page = {'offset': offset}
+        def fetch():
+            try:
+                page['results'] = self.get_page(offset)
+            except Exception:
+                page['error'] = sys.exc_info()
+        page['thread'] = threading.Thread(target=fetch)
+        page['thread'].daemon = True
+        page['thread'].start()
+        self.next_page = page
+
     def fetch_batch_of_results(self):
-        uri = "/evaluation/submission/query?query=" + urllib.quote_plus("%s limit %s offset %s" % (self.query, self.limit, self.offset))
-        results = syn.restGET(uri)
+        page = self.next_page
+        self.next_page = None
+        if page is not None and page['offset'] == self.offset:
+            page['thread'].join()
+            if 'error' in page:
+                raise page['error'][0], page['error'][1], page['error'][2]
+            results = page['results']
+        else:
+            results = self.get_page(self.offset)
         self.totalNumberOfResults = results['totalNumberOfResults']
         self.headers = results['headers']
         self.rows = results['rows']
         self.i = 0
+        if self.prefetch and self.offset + len(self.rows) < self.totalNumberOfResults:
+            self.prefetch_page(self.offset + len(self.rows))
 
     def __iter__(self):
         return self
@@ -150,24 +298,24 @@ class Query(object):
             if self.offset >= self.totalNumberOfResults:
                 raise StopIteration()
             self.fetch_batch_of_results()
+            ## the queue shrank while paging
+            if len(self.rows) == 0:
+                raise StopIteration()
         values = self.rows[self.i]['values']
         self.i += 1
         self.offset += 1
         return values
 
 
-def validate(evaluation, token, dry_run=False):
-
-    if type(evaluation) != Evaluation:
-        evaluation = syn.getEvaluation(evaluation)
-
-    print "\n\nValidating", evaluation.id, evaluation.name
-    print "-" * 60
-    sys.stdout.flush()
-
-
-    for submission, status in syn.getSubmissionBundles(evaluation, status='RECEIVED'):
+def validate_one(evaluation, submission, status, token):
+    """
+    Download and validate one submission, in a worker thread of validate().
 
+    :returns: (submission, status, is_valid, message). is_valid is None if the
+              submission couldn't be downloaded, it then stays RECEIVED and
+              is picked up again by the next run.
+    """
+    try:
         ## refetch the submission so that we get the file path
         ## to be later replaced by a "downloadFiles" flag on getSubmissionBundles
         sub = json.loads(submission['entityBundleJSON'])
@@ -178,40 +326,143 @@ def validate(evaluation, token, dry_run=False):
                 submission = syn.getSubmission(submission)
             else:
                 submission = syn.getSubmission(submission,downloadFile=False)
+    except Exception as ex1:
+        sys.stderr.write('\n\nError downloading submission %s:\n' % submission.id)
+        traceback.print_exc()
+        return submission, status, None, str(ex1)
 
-        print "validating", submission.id, submission.name
-        try:
-            is_valid, validation_message = conf.validate_submission(evaluation, submission, token)
-        except Exception as ex1:
-            is_valid = False
-            print "Exception during validation:", type(ex1), ex1, ex1.message
-            traceback.print_exc()
-            validation_message = str(ex1)
+    print "validating", submission.id, submission.name
+    try:
+        is_valid, validation_message = conf.validate_submission(evaluation, submission, token)
+    except Exception as ex1:
+        is_valid = False
+        print "Exception during validation:", type(ex1), ex1, ex1.message
+        traceback.print_exc()
+        validation_message = str(ex1)
+
+    status.status = "VALIDATED" if is_valid else "INVALID"
+
+    ## look up the user here so that it doesn't wait on the status upload
+    try:
+        username = get_user_name_by_id(submission.userId)
+    except Exception as ex1:
+        traceback.print_exc()
+        username = submission.userId
 
-        status.status = "VALIDATED" if is_valid else "INVALID"
+    return submission, status, is_valid, (validation_message, username)
 
-        if not dry_run:
-            status = syn.store(status)
 
-        ## send message AFTER storing status to ensure we don't get repeat messages
-        profile = syn.getUserProfile(submission.userId)
+def store_validation_results(evaluation, results, dry_run=False):
+    """
+    Store the statuses of validated submissions in one batch upload, then
+    tell the submitters.
+    """
+    if not dry_run and len(results) > 0:
+        unwritten = update_submissions_status_batch(evaluation, [status for submission, status, is_valid, message in results])
+        ## these stay RECEIVED, their submitters hear about them on a later run
+        unwritten = set(status.id for status in unwritten)
+        results = [result for result in results if result[1].id not in unwritten]
+
+    ## send message AFTER storing status to ensure we don't get repeat messages
+    for submission, status, is_valid, (validation_message, username) in results:
         if is_valid:
             messages.validation_passed(
                 userIds=[submission.userId],
-                username=get_user_name(profile),
+                username=username,
                 queue_name=evaluation.name,
                 submission_id=submission.id,
                 submission_name=submission.name)
         else:
             messages.validation_failed(
                 userIds=[submission.userId],
-                username=get_user_name(profile),
+                username=username,
                 queue_name=evaluation.name,
                 submission_id=submission.id,
                 submission_name=submission.name,
                 message=validation_message)
 
 
+def validate(evaluation, token, dry_run=False, workers=VALIDATION_WORKERS):
+
+    if type(evaluation) != Evaluation:
+        evaluation = syn.getEvaluation(evaluation)
+
+    print "\n\nValidating", evaluation.id, evaluation.name
+    print "-" * 60
+    sys.stdout.flush()
+
+    ## look ACLs up again on each run, they may have been fixed since
+    conf.clear_acl_cache()
+
+    ## submissions are downloaded and validated by a bounded pool of threads,
+    ## their statuses are stored BATCH_SIZE at a time as they come back
+    pool = ThreadPool(max(1, workers))
+    try:
+        bundles = syn.getSubmissionBundles(evaluation, status='RECEIVED')
+        results = []
+        for result in pool.imap_unordered(lambda bundle: validate_one(evaluation, bundle[0], bundle[1], token), bundles):
+            if result[2] is None:
+                continue
+            results.append(result)
+            if len(results) >= BATCH_SIZE:
+                store_validation_results(evaluation, results, dry_run)
+                results = []
+        store_validation_results(evaluation, results, dry_run)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def download_for_scoring(evaluation):
+    """
+    Yield (evaluation, submission, status) for each VALIDATED submission
+    once its file is downloaded. A submission that can't be downloaded is
+    skipped and stays VALIDATED for the next run.
+    """
+    for submission, status in syn.getSubmissionBundles(evaluation, status='VALIDATED'):
+        try:
+            ## refetch the submission so that we get the file path
+            ## to be later replaced by a "downloadFiles" flag on getSubmissionBundles
+            sub = json.loads(submission['entityBundleJSON'])
+            if sub['fileHandles'][0].get('externalURL') is None:
+                submission = syn.getSubmission(submission)
+            else:
+                submission = syn.getSubmission(submission,downloadFile=False)
+        except Exception as ex1:
+            sys.stderr.write('\n\nError downloading submission %s:\n' % submission.id)
+            traceback.print_exc()
+            continue
+        yield evaluation, submission, status
+
+
+def score_one(task):
+    """
+    Score one submission in a worker process of score(). Errors are returned
+    as their traceback, so that one failure doesn't stop the other workers.
+
+    :returns: (submission, status, score, message, error, worker pid, seconds)
+    """
+    evaluation, submission, status = task
+    start = time.time()
+    try:
+        score, message = conf.score_submission(evaluation, submission)
+        error = None
+    except Exception as ex1:
+        st = StringIO()
+        traceback.print_exc(file=st)
+        score, message, error = None, None, st.getvalue()
+    return submission, status, score, message, error, os.getpid(), time.time()-start
+
+
+def print_scoring_stats(stats, elapsed, workers):
+    """Print the throughput of score() and the latency of each worker"""
+    count = sum(len(latencies) for latencies in stats.values())
+    print "finished %d submissions in %0.1f seconds with %d workers, %0.2f per minute" % (count, elapsed, workers, count*60.0/elapsed if elapsed > 0 else 0.0)
+    for pid in sorted(stats):
+        latencies = stats[pid]
+        print "  worker %s: %d submissions, latency mean %0.1f max %0.1f seconds" % (pid, len(latencies), sum(latencies)/len(latencies), max(latencies))
+
+
 def score(evaluation, dry_run=False):
 
     if type(evaluation) != Evaluation:
@@ -221,86 +472,114 @@ def score(evaluation, dry_run=False):
     print "-" * 60
     sys.stdout.flush()
 
-    for submission, status in syn.getSubmissionBundles(evaluation, status='VALIDATED'):
+    ## submissions are scored in a pool of processes sized for this queue,
+    ## the results are stored and announced here as they come back
+    workers = conf.scoring_workers(evaluation)
+    pool = Pool(workers)
+    stats = {}
+    leaderboard = []
+    start = time.time()
+    try:
+        for submission, status, score, message, error, pid, latency in pool.imap_unordered(score_one, download_for_scoring(evaluation)):
+            stats.setdefault(pid, []).append(latency)
+            store_score(evaluation, submission, status, score, message, error, dry_run, leaderboard)
+    except:
+        ## stop scoring the remaining submissions, their results would be lost
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+        ## if there's a table configured, update it in one go, also when
+        ## scoring failed midway, for the submissions already stored as SCORED
+        if not dry_run and evaluation.id in conf.leaderboard_tables and len(leaderboard) > 0:
+            update_leaderboard_table_batch(conf.leaderboard_tables[evaluation.id], leaderboard, dry_run=False)
 
-        status.status = "INVALID"
+    print_scoring_stats(stats, time.time()-start, workers)
+    sys.stdout.write('\n')
 
-        ## refetch the submission so that we get the file path
-        ## to be later replaced by a "downloadFiles" flag on getSubmissionBundles
-        sub = json.loads(submission['entityBundleJSON'])
-        if sub['fileHandles'][0].get('externalURL') is None:
-            submission = syn.getSubmission(submission)
-        else:
-            submission = syn.getSubmission(submission,downloadFile=False)
 
-        try:
-            score, message = conf.score_submission(evaluation, submission)
+def store_score(evaluation, submission, status, score, message, error, dry_run=False, leaderboard=None):
+    """
+    Store the result of scoring a submission, update the leaderboard and
+    tell the submitter.
+
+    :param error: the traceback if scoring failed, else None
+    :param leaderboard: if given, (submission, score) is added to this list
+                        for update_leaderboard_table_batch instead of
+                        updating the leaderboard table right away
+    """
+    status.status = "INVALID"
 
+    if error is None:
+        try:
             print "scored:", submission.id, submission.name, submission.userId, score
 
             ## fill in team in submission status annotations
             if 'teamId' in submission:
-                team = syn.restGET('/team/{id}'.format(id=submission.teamId))
-                if 'name' in team:
-                    score['team'] = team['name']
-                else:
-                    score['team'] = submission.teamId
+                score['team'] = get_team_name(submission.teamId)
             elif 'userId' in submission:
-                profile = syn.getUserProfile(submission.userId)
-                score['team'] = get_user_name(profile)
+                score['team'] = get_user_name_by_id(submission.userId)
             else:
                 score['team'] = '?'
 
             status.annotations = synapseclient.annotations.to_submission_status_annotations(score,is_private=True)
             status.status = "SCORED"
             ## if there's a table configured, update it
-            if not dry_run and evaluation.id in conf.leaderboard_tables:
+            if leaderboard is not None:
+                leaderboard.append((submission, score))
+            elif not dry_run and evaluation.id in conf.leaderboard_tables:
                 update_leaderboard_table(conf.leaderboard_tables[evaluation.id], submission, fields=score, dry_run=False)
 
         except Exception as ex1:
-            sys.stderr.write('\n\nError scoring submission %s %s:\n' % (submission.name, submission.id))
+            status.status = "INVALID"
             st = StringIO()
             traceback.print_exc(file=st)
-            sys.stderr.write(st.getvalue())
-            sys.stderr.write('\n')
-            message = st.getvalue()
-
-            if conf.ADMIN_USER_IDS:
-                submission_info = "submission id: %s\nsubmission name: %s\nsubmitted by user id: %s\n\n" % (submission.id, submission.name, submission.userId)
-                messages.error_notification(userIds=conf.ADMIN_USER_IDS, message=submission_info+st.getvalue())
-
-        if not dry_run:
-            status = syn.store(status)
+            error = st.getvalue()
 
-        ## send message AFTER storing status to ensure we don't get repeat messages
-        profile = syn.getUserProfile(submission.userId)
+    if error is not None:
+        sys.stderr.write('\n\nError scoring submission %s %s:\n' % (submission.name, submission.id))
+        sys.stderr.write(error)
+        sys.stderr.write('\n')
+        message = error
 
-        if status.status == 'SCORED':
-            messages.scoring_succeeded(
-                userIds=[submission.userId],
-                message=message,
-                username=get_user_name(profile),
-                queue_name=evaluation.name,
-                submission_name=submission.name,
-                submission_id=submission.id)
-        else:
-            messages.scoring_failed(
-                userIds=[submission.userId],
-                message=message,
-                username=get_user_name(profile),
-                queue_name=evaluation.name,
-                submission_name=submission.name,
-                submission_id=submission.id)
+        if conf.ADMIN_USER_IDS:
+            submission_info = "submission id: %s\nsubmission name: %s\nsubmitted by user id: %s\n\n" % (submission.id, submission.name, submission.userId)
+            messages.error_notification(userIds=conf.ADMIN_USER_IDS, message=submission_info+error)
 
-    sys.stdout.write('\n')
+    if not dry_run:
+        status = syn.store(status)
+
+    ## send message AFTER storing status to ensure we don't get repeat messages
+    username = get_user_name_by_id(submission.userId)
+
+    if status.status == 'SCORED':
+        messages.scoring_succeeded(
+            userIds=[submission.userId],
+            message=message,
+            username=username,
+            queue_name=evaluation.name,
+            submission_name=submission.name,
+            submission_id=submission.id)
+    else:
+        messages.scoring_failed(
+            userIds=[submission.userId],
+            message=message,
+            username=username,
+            queue_name=evaluation.name,
+            submission_name=submission.name,
+            submission_id=submission.id)
 
 
 def create_leaderboard_table(name, columns, parent, evaluation, dry_run=False):
     if not dry_run:
         schema = syn.store(Schema(name=name, columns=cols, parent=project))
+    entries = []
     for submission, status in syn.getSubmissionBundles(evaluation):
         annotations = synapseclient.annotations.from_submission_status_annotations(status.annotations) if 'annotations' in status else {}
-        update_leaderboard_table(schema.id, submission, annotations, dry_run)
+        entries.append((submission, annotations))
+    update_leaderboard_table_batch(schema.id, entries, dry_run)
 
 
 def update_leaderboard_table(leaderboard_table, submission, fields, dry_run=False):
@@ -310,13 +589,7 @@ def update_leaderboard_table(leaderboard_table, submission, fields, dry_run=Fals
     :param fields: a dictionary including all scoring statistics plus the team name for the submission.
     """
 
-    ## copy fields from submission
-    ## fields should already contain scoring stats
-    fields['objectId'] = submission.id
-    fields['userId'] = submission.userId
-    fields['entityId'] = submission.entityId
-    fields['versionNumber'] = submission.versionNumber
-    fields['name'] = submission.name
+    add_submission_fields(submission, fields)
 
     results = syn.tableQuery("select * from %s where objectId=%s" % (leaderboard_table, submission.id), resultsAs="rowset")
     rowset = results.asRowSet()
@@ -342,6 +615,71 @@ def update_leaderboard_table(leaderboard_table, submission, fields, dry_run=Fals
         return syn.store(rowset)
 
 
+def add_submission_fields(submission, fields):
+    ## copy fields from submission
+    ## fields should already contain scoring stats
+    fields['objectId'] = submission.id
+    fields['userId'] = submission.userId
+    fields['entityId'] = submission.entityId
+    fields['versionNumber'] = submission.versionNumber
+    fields['name'] = submission.name
+
+
+def update_leaderboard_table_batch(leaderboard_table, entries, dry_run=False):
+    """
+    Insert or update the records of many submissions in a leaderboard table.
+    The table is read with one query, only new or changed rows are written,
+    LEADERBOARD_BATCH_SIZE rows per store.
+
+    :param entries: a list of (submission, fields) pairs, fields as for
+                    update_leaderboard_table. A later entry for the same
+                    submission replaces an earlier one.
+    :returns: the number of rows inserted or updated
+    """
+    results = syn.tableQuery("select * from %s" % leaderboard_table, resultsAs="rowset")
+    rowset = results.asRowSet()
+    names = [col['name'] for col in rowset['headers']]
+    object_index = names.index('objectId')
+
+    ## index the rows already in the table by submission
+    existing = {}
+    for row in rowset['rows']:
+        objectId = unicode(row['values'][object_index])
+        if objectId in existing:
+            ## shouldn't happen
+            raise RuntimeError("Multiple entries in leaderboard table %s for submission %s" % (leaderboard_table,objectId))
+        existing[objectId] = row
+
+    ## table queries return strings, so compare values as strings
+    def as_text(values):
+        return [None if value is None else unicode(value) for value in values]
+
+    latest = OrderedDict()
+    for submission, fields in entries:
+        latest[unicode(submission.id)] = (submission, fields)
+
+    changed = []
+    for objectId, (submission, fields) in latest.iteritems():
+        add_submission_fields(submission, fields)
+        values = [fields.get(name, None) for name in names]
+        row = existing.get(objectId)
+        if row is None:
+            changed.append({'values':values})
+        elif as_text(row['values']) != as_text(values):
+            row['values'] = values
+            changed.append(row)
+
+    for offset in range(0, len(changed), LEADERBOARD_BATCH_SIZE):
+        batch = copy.copy(rowset)
+        batch['rows'] = changed[offset:offset+LEADERBOARD_BATCH_SIZE]
+        if dry_run:
+            for row in batch['rows']:
+                print "update row %s" % row['rowId'] if 'rowId' in row else "insert new row", row['values']
+        else:
+            syn.store(batch)
+    return len(changed)
+
+
 def query(evaluation, columns, out=sys.stdout):
     """Test the query that will be run to construct the leaderboard"""
 
@@ -393,11 +731,167 @@ def list_evaluations(project):
     for evaluation in evaluations:
         print "Evaluation: %s" % evaluation.id, evaluation.name.encode('utf-8')
 
+def load_archive_manifest(manifest_path):
+    """
+    The manifest of an archive run records what earlier runs already
+    archived, so that a run can stop at any point and the next one carries on.
+    """
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            return json.load(f)
+    return {'submissions':{}, 'cwl':{}, 'entities':{}, 'docker':{}, 'mapping':[]}
+
+
+def save_archive_manifest(manifest_path, manifest):
+    ## write a new file and rename it, so a crash never leaves half a manifest
+    with open(manifest_path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.rename(manifest_path + ".tmp", manifest_path)
+
+
+def flush_archive_mapping(mapping, manifest_path, manifest):
+    """Append the pending rows of the synid to bucket mapping table in one store"""
+    if len(manifest['mapping']) > 0:
+        syn.store(Table(mapping, manifest['mapping']))
+        manifest['mapping'] = []
+        save_archive_manifest(manifest_path, manifest)
+
+
+def archive_command(command):
+    """Run a shell command of the archive, raising CalledProcessError if it fails"""
+    subprocess.check_call(command, shell=True)
+
+
+def archive_docker_image(image, path, submissionId, manifest):
+    """
+    Pull a docker image and copy it to the bucket, unless an image with the
+    same content was archived before. Images are told apart by their ID, the
+    digest of their content, so that tags of the same image are archived
+    once and a tag that moved to a new image is archived again.
+    """
+    archive_command('sudo -i docker pull %s' % image)
+    image_id = subprocess.check_output('sudo docker inspect --format "{{.Id}}" %s' % image, shell=True).strip()
+    if image_id in manifest['docker']:
+        return
+    fileName = os.path.basename(image).replace(":","_")
+    archive_command('sudo docker save -o %s.tar %s' %(fileName,image))
+    archive_command('sudo chmod a+r %s.tar' % fileName)
+    archive_command('gsutil cp %s.tar gs://smc-rna-eval/entries/%s/%s' % (fileName,path,submissionId))
+    os.remove("%s.tar" % fileName)
+    manifest['docker'][image_id] = {'image':image, 'location':"gs://smc-rna-eval/entries/%s/%s/%s.tar" % (path,submissionId,fileName)}
+
+
+def file_sha256(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024*1024), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def summarize_archived_cwl(docs):
+    """Docker images and synData entities used by a merged CWL file"""
+    merged = docs['$graph']
+    docker = []
+    entities = []
+    for tools in merged:
+        if tools['class'] == 'CommandLineTool':
+            if tools.get('requirements',None) is not None:
+                for i in tools['requirements']:
+                    if i.get('dockerPull',None) is not None:
+                        docker.append(i['dockerPull'])
+            if tools.get('hints', None) is not None:
+                for i in tools['hints']:
+                    if i.get('dockerPull',None) is not None:
+                        docker.append(i['dockerPull'])
+        if tools['class'] == 'Workflow':
+            hints = tools.get("hints",None)
+            if hints is not None:
+                for i in tools['hints']:
+                    if os.path.basename(i['class']) == "synData":
+                        entities.append(i['entity'])
+    return {'docker':docker, 'entities':entities}
+
+
+def summarize_archived_task(docs):
+    """Docker images used by the CWL of a CGC task"""
+    # merged = docs['steps']
+    # docker = []
+    # for tools in merged:
+    #     for hint in tools['run']['hints']:
+    #         if hint['class'] == 'DockerRequirement':
+    #             docker.append(hint['dockerPull'])
+    #     for require in tools['run']['requirements']:
+    #         if require.get('requirements') is not None:
+    #             for i in require.get('requirements'):
+    #                 if i['class'] == 'DockerRequirement':
+    #                     docker.append(i['dockerPull'])
+    docker = []
+    for tools in docs['hints']:
+        if tools['class'] == "DockerRequirement":
+            docker.append(tools['dockerPull'])
+    return {'docker':docker, 'entities':[]}
+
+
+def archive_submission(submissionId, path, token, manifest):
+    """
+    Copy the CWL of a submission and its index files to the bucket.
+    CWL files already seen, by content, aren't parsed again and index files
+    already in the bucket aren't copied again.
+
+    :returns: the hash of the CWL of the submission and the new rows of the
+              synid to bucket mapping table
+    """
+    new_map = []
+    ## left over by a run that crashed
+    if os.path.exists(submissionId):
+        shutil.rmtree(submissionId)
+    os.mkdir(submissionId)
+    submission = syn.getSubmission(submissionId, downloadFile=False)
+    if submission.entity.externalURL is None:
+        submission = syn.getSubmission(submissionId, downloadLocation=submissionId)
+        newFilePath = submission.filePath.replace(' ', '_')
+        shutil.move(submission.filePath,newFilePath)
+        #Store CWL file in bucket
+        archive_command('gsutil cp -R %s gs://smc-rna-eval/entries/%s' % (submissionId,path))
+        cwl_hash = file_sha256(newFilePath)
+        if cwl_hash not in manifest['cwl']:
+            with open(newFilePath,"r") as cwlfile:
+                manifest['cwl'][cwl_hash] = summarize_archived_cwl(yaml.load(cwlfile))
+        for entity in manifest['cwl'][cwl_hash]['entities']:
+            if entity not in manifest['entities']:
+                temp = syn.get(entity)
+                location = "gs://smc-rna-eval/entries/%s/%s/%s" %(path,submissionId,temp.name)
+                #Store index files
+                archive_command('gsutil cp %s gs://smc-rna-eval/entries/%s/%s' % (temp.path,path,submissionId))
+                #create synid and index mapping
+                new_map.append([temp.id,location])
+                manifest['entities'][entity] = location
+        os.system('rm -rf ~/.synapseCache/*')
+    else:
+        if submission.entity.externalURL.endswith("/"):
+            submission.entity.externalURL = submission.entity.externalURL[:-1]
+        taskId = submission.entity.externalURL.split("/")[-1]
+        test = subprocess.check_call(["python", os.path.join(os.path.dirname(__file__),"../../SMC-RNA-Eval/sbg-download.py"), "--token", token, taskId, submissionId])
+        archive_command('gsutil cp -R %s gs://smc-rna-eval/entries/%s' % (submissionId,path))
+        #Pull down docker containers
+        cwl_hash = file_sha256("%s/submission.cwl" % submissionId)
+        if cwl_hash not in manifest['cwl']:
+            with open("%s/submission.cwl" % submissionId,"r") as cwlfile:
+                manifest['cwl'][cwl_hash] = summarize_archived_task(yaml.load(cwlfile))
+    os.system('rm -rf %s' % submissionId)
+    return cwl_hash, new_map
+
+
 #Special archive function written for SMC-RNA
 def archive(evaluation, destination=None, token=None, name=None, query=None):
     """
     Archive the submissions for the given evaluation queue and store them in the destination synapse folder.
 
+    Archiving is incremental: a manifest in the working directory records the
+    submissions, index files and docker images already archived, a run that
+    stops part way through is resumed by running it again.
+
     :param evaluation: a synapse evaluation queue or its ID
     :param destination: a synapse folder or its ID
     :param query: a query that will return the desired submissions. At least the ID must be returned.
@@ -407,89 +901,42 @@ def archive(evaluation, destination=None, token=None, name=None, query=None):
     if not query:
         query = 'select * from evaluation_%s where status=="SCORED"' % utils.id_of(evaluation)
     path = challenge[utils.id_of(evaluation)]
+    manifest_path = ARCHIVE_MANIFEST % utils.id_of(evaluation)
+    manifest = load_archive_manifest(manifest_path)
+    mapping = syn.get(ARCHIVE_MAPPING_TABLE)
+    ## rows a crashed run didn't get to store
+    flush_archive_mapping(mapping, manifest_path, manifest)
+
     ## for each submission, download it's associated file and write a line of metadata
     results = Query(query=query)
     if 'objectId' not in results.headers:
         raise ValueError("Can't find the required field \"objectId\" in the results of the query: \"{0}\"".format(query))
+
+    #A folder in synapse is created for each archived submission
+    #(This is used as a tool to check submissions that have already been cached)
+    folders = set()
+    for folder in syn.chunkedQuery('select id,name from folder where parentId == "%s"' % utils.id_of(destination)):
+        folders.add(folder['folder.name'])
+
     for result in results:
-        #Check if the folder has already been created in synapse 
-        #(This is used as a tool to check submissions that have already been cached)
-        new_map = []
-        mapping = syn.get("syn7348150")
         submissionId = result[results.headers.index('objectId')]
-        check = syn.query('select id,name from folder where parentId == "%s" and name == "%s"' % (destination,submissionId))
-        if check['totalNumberOfResults']==0:
-            os.mkdir(submissionId)
-            submission = syn.getSubmission(submissionId, downloadFile=False)
-            if submission.entity.externalURL is None:
-                submission = syn.getSubmission(submissionId, downloadLocation=submissionId)
-                newFilePath = submission.filePath.replace(' ', '_')
-                shutil.move(submission.filePath,newFilePath)
-                #Store CWL file in bucket
-                os.system('gsutil cp -R %s gs://smc-rna-eval/entries/%s' % (submissionId,path))
-                with open(newFilePath,"r") as cwlfile:
-                    docs = yaml.load(cwlfile)
-                    merged = docs['$graph']
-                    docker = []
-                    for tools in merged:
-                        if tools['class'] == 'CommandLineTool':
-                            if tools.get('requirements',None) is not None:
-                                for i in tools['requirements']:
-                                    if i.get('dockerPull',None) is not None:
-                                        docker.append(i['dockerPull'])
-                            if tools.get('hints', None) is not None:
-                                for i in tools['hints']:
-                                    if i.get('dockerPull',None) is not None:
-                                        docker.append(i['dockerPull']) 
-                        if tools['class'] == 'Workflow':
-                            hints = tools.get("hints",None)
-                            if hints is not None:
-                                for i in tools['hints']:
-                                    if os.path.basename(i['class']) == "synData":
-                                        temp = syn.get(i['entity'])
-                                        #create synid and index mapping
-                                        new_map.append([temp.id,"gs://smc-rna-eval/entries/%s/%s/%s" %(path,submissionId,temp.name)])
-                                        #Store index files
-                                        os.system('gsutil cp %s gs://smc-rna-eval/entries/%s/%s' % (temp.path,path,submissionId))
-                os.system('rm -rf ~/.synapseCache/*')
-            else:
-                if submission.entity.externalURL.endswith("/"):
-                    submission.entity.externalURL = submission.entity.externalURL[:-1]
-                taskId = submission.entity.externalURL.split("/")[-1]
-                test = subprocess.check_call(["python", os.path.join(os.path.dirname(__file__),"../../SMC-RNA-Eval/sbg-download.py"), "--token", token, taskId, submissionId])
-                os.system('gsutil cp -R %s gs://smc-rna-eval/entries/%s' % (submissionId,path))
-                #Pull down docker containers
-                with open("%s/submission.cwl" % submissionId,"r") as cwlfile:
-                    docs = yaml.load(cwlfile)
-                    # merged = docs['steps']
-                    # docker = []
-                    # for tools in merged:
-                    #     for hint in tools['run']['hints']:
-                    #         if hint['class'] == 'DockerRequirement':
-                    #             docker.append(hint['dockerPull'])
-                    #     for require in tools['run']['requirements']:
-                    #         if require.get('requirements') is not None:
-                    #             for i in require.get('requirements'):
-                    #                 if i['class'] == 'DockerRequirement':
-                    #                     docker.append(i['dockerPull'])
-                    docker = []
-                    for tools in docs['hints']:
-                        if tools['class'] == "DockerRequirement":
-                            docker.append(tools['dockerPull'])
-            os.system('rm -rf %s' % submissionId)
-            if len(new_map) > 0:
-                table = syn.store(Table(mapping, new_map))
-            #Pull, save, and store docker containers
-            docker = set(docker)
-            for i in docker:
-                fileName = os.path.basename(i).replace(":","_")
-                os.system('sudo -i docker pull %s' % i)
-                #os.system('sudo -i docker save %s' % i)
-                os.system('sudo docker save -o %s.tar %s' %(fileName,i))
-                os.system('sudo chmod a+r %s.tar' % fileName)
-                os.system('gsutil cp %s.tar gs://smc-rna-eval/entries/%s/%s' % (fileName,path,submissionId))
-                os.remove("%s.tar" % fileName)
-            submission_parent = syn.store(Folder(submissionId,parent=destination))
+        if submissionId in folders:
+            continue
+        if submissionId not in manifest['submissions']:
+            cwl_hash, new_map = archive_submission(submissionId, path, token, manifest)
+            #Pull, save, and store docker containers not archived yet
+            for i in set(manifest['cwl'][cwl_hash]['docker']):
+                archive_docker_image(i, path, submissionId, manifest)
+            ## the manifest is saved before the folder is created, a run that
+            ## stops in between only has the folder left to create
+            manifest['submissions'][submissionId] = {'cwl':cwl_hash}
+            manifest['mapping'].extend(new_map)
+            save_archive_manifest(manifest_path, manifest)
+        submission_parent = syn.store(Folder(submissionId,parent=destination))
+        folders.add(submissionId)
+        if len(manifest['mapping']) >= ARCHIVE_MAPPING_BATCH_SIZE:
+            flush_archive_mapping(mapping, manifest_path, manifest)
+    flush_archive_mapping(mapping, manifest_path, manifest)
 
 
 
@@ -497,6 +944,33 @@ def archive(evaluation, destination=None, token=None, name=None, query=None):
 ##  Handlers for commands
 ## ==================================================
 
+def command_lock_names(args):
+    """
+    Names of the locks a command needs: one per evaluation queue it works
+    on for the commands that handle a queue, else one for the command, so
+    that different queues and commands can run at the same time.
+
+    reset rewrites the statuses validate and score work on, so it also takes
+    their locks, of every queue since the submissions it is given can be in
+    any of them.
+    """
+    phase = args.func.__name__.replace("command_", "")
+    if phase == "reset":
+        queues = [utils.id_of(queue_info['id']) for queue_info in conf.evaluation_queues]
+        return [lock.lock_name(phase)] + [lock.lock_name(status_phase, queue)
+                                          for queue in queues for status_phase in ("validate", "score")]
+    if phase in ("validate", "score", "archive"):
+        if getattr(args, 'all', False):
+            queues = [queue_info['id'] for queue_info in conf.evaluation_queues]
+        elif args.evaluation:
+            queues = [args.evaluation]
+        else:
+            queues = []
+        if len(queues) > 0:
+            return [lock.lock_name(phase, utils.id_of(queue)) for queue in queues]
+    return [lock.lock_name(phase)]
+
+
 def command_list(args):
     """
     List either the submissions to an evaluation queue or
@@ -544,9 +1018,9 @@ def command_reset(args):
 def command_validate(args):
     if args.all:
         for queue_info in conf.evaluation_queues:
-            validate(queue_info['id'], args.token, dry_run=args.dry_run)
+            validate(queue_info['id'], args.token, dry_run=args.dry_run, workers=args.workers)
     elif args.evaluation:
-        validate(args.evaluation, args.token, dry_run=args.dry_run)
+        validate(args.evaluation, args.token, dry_run=args.dry_run, workers=args.workers)
     else:
         sys.stderr.write("\nValidate command requires either an evaluation ID or --all to validate all queues in the challenge")
 
@@ -578,6 +1052,19 @@ def command_leaderboard(args):
         query(args.evaluation, columns=leaderboard_cols)
 
 
+def command_forget_names(args):
+    """
+    Drop user and team names from the name cache, so that they are looked
+    up again. Drops all names if no user or team is given.
+    """
+    if not args.user_id and not args.team_id:
+        name_cache.invalidate()
+    for userId in args.user_id:
+        name_cache.invalidate('user/%s' % userId)
+    for teamId in args.team_id:
+        name_cache.invalidate('team/%s' % teamId)
+
+
 def command_archive(args):
     archive(args.evaluation, destination=args.destination, token=args.token, name=args.name, query=args.query)
 
@@ -592,6 +1079,7 @@ def main():
         sys.stderr.write("Please configure your challenge. See sample_challenge.py for an example.")
 
     global syn
+    global name_cache
 
     parser = argparse.ArgumentParser()
 
@@ -602,6 +1090,7 @@ def main():
     parser.add_argument("--acknowledge-receipt", help="Send confirmation message on passing validation to participants", action="store_true", default=False)
     parser.add_argument("--dry-run", help="Perform the requested command without updating anything in Synapse", action="store_true", default=False)
     parser.add_argument("--debug", help="Show verbose error output from Synapse API calls", action="store_true", default=False)
+    parser.add_argument("--name-cache-ttl", help="Hours user and team names are cached for", type=float, default=namecache.NAME_CACHE_DEFAULT_TTL.total_seconds()/3600)
 
     subparsers = parser.add_subparsers(title="subcommand")
 
@@ -626,6 +1115,7 @@ def main():
     parser_validate.add_argument("evaluation", metavar="EVALUATION-ID", nargs='?', default=None, )
     parser_validate.add_argument("--all", action="store_true", default=False)
     parser_validate.add_argument("--token", metavar='API key', type=str, default=None, required=True)
+    parser_validate.add_argument("--workers", help="Number of submissions validated at the same time", type=int, default=VALIDATION_WORKERS)
     parser_validate.set_defaults(func=command_validate)
 
     parser_score = subparsers.add_parser('score', help="Score all VALIDATED submissions to an evaluation")
@@ -645,6 +1135,11 @@ def main():
     parser_archive.add_argument("-n", "--name", default=None)
     parser_archive.set_defaults(func=command_archive)
 
+    parser_forget_names = subparsers.add_parser('forget-names', help="Drop cached user and team names so that they are looked up again")
+    parser_forget_names.add_argument("--user-id", metavar="USER-ID", nargs='*', default=[])
+    parser_forget_names.add_argument("--team-id", metavar="TEAM-ID", nargs='*', default=[])
+    parser_forget_names.set_defaults(func=command_forget_names)
+
     parser_leaderboard = subparsers.add_parser('leaderboard', help="Print the leaderboard for an evaluation")
     parser_leaderboard.add_argument("evaluation", metavar="EVALUATION-ID", default=None)
     parser_leaderboard.add_argument("--out", default=None)
@@ -655,11 +1150,11 @@ def main():
     print "\n" * 2, "=" * 75
     print datetime.utcnow().isoformat()
 
-    ## Acquire lock, don't run two scoring scripts at once
+    ## Acquire locks, don't run the same command on the same queue twice at once
     try:
-        update_lock = lock.acquire_lock_or_fail('challenge', max_age=timedelta(hours=4))
-    except lock.LockedException:
-        print u"Is the scoring script already running? Can't acquire lock."
+        update_locks = lock.acquire_locks_or_fail(command_lock_names(args), max_age=LOCK_MAX_AGE)
+    except lock.LockedException as ex1:
+        print u"Is the scoring script already running? Can't acquire lock.", ex1
         # can't acquire lock, so return error code 75 which is a
         # temporary error according to /usr/include/sysexits.h
         return 75
@@ -679,6 +1174,9 @@ def main():
         messages.send_notifications = args.notifications
         messages.acknowledge_receipt = args.acknowledge_receipt
 
+        ## the name cache lives next to the lock
+        name_cache = namecache.NameCache(os.path.join(os.getcwd(), NAME_CACHE_FILE), ttl=timedelta(hours=args.name_cache_ttl))
+
         args.func(args)
 
     except Exception as ex1:
@@ -692,7 +1190,10 @@ def main():
             messages.error_notification(userIds=conf.ADMIN_USER_IDS, message=st.getvalue(), queue_name=conf.CHALLENGE_NAME)
 
     finally:
-        update_lock.release()
+        if name_cache is not None:
+            name_cache.close()
+        for update_lock in update_locks:
+            update_lock.release()
 
     print "\ndone: ", datetime.utcnow().isoformat()
     print "=" * 75, "\n" * 2
@@ -9,6 +9,16 @@ import subprocess
 import yaml
 import os
 import requests
+import hashlib
+import json
+import sys
+import tempfile
+import threading
+from multiprocessing.pool import ThreadPool
+
+## the checks of merged CWL files are shared with smc_rna_submit.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "script"))
+import cwl_checker
 
 ## A Synapse project will hold the assetts for your challenge. Put its
 ## synapse ID here, for example
@@ -21,7 +31,7 @@ CHALLENGE_NAME = "SMC-RNA Challenge"
 ## Synapse user IDs of the challenge admins who will be notified by email
 ## about errors in the scoring script
 ADMIN_USER_IDS = ["3324230"]
-PROVIDED = ["TUMOR_FASTQ_1","TUMOR_FASTQ_2","REFERENCE_GENOME","REFERENCE_GTF"]
+PROVIDED = cwl_checker.PROVIDED
 
 ## Each question in your challenge should have an evaluation queue through
 ## which participants can submit their predictions or models. The queues
@@ -83,104 +93,147 @@ for q in evaluation_queues:
 ## where the table holds a leaderboard for that question
 leaderboard_tables = {}
 
+## Structural checks of a merged CWL file are cached by the hash of the file.
+## Bump CWL_VALIDATOR_VERSION whenever check_cwl changes, so that results
+## of the old checks aren't used anymore.
+CWL_VALIDATOR_VERSION = 3
+CWL_VALIDATION_CACHE_DIR = "cwl-validation-cache"
+
+## the server has always told participants to merge with --CWLfile
+MERGE_HINT = "Please run 'python smc_rna_submit.py merge --CWLfile %s'"
+
+
+## ACLs of synData entities are looked up ACL_WORKERS at a time and
+## remembered until clear_acl_cache() is called, once per validation run
+ACL_WORKERS = 8
+acl_cache = {}
+acl_cache_lock = threading.Lock()
+
+
+class CachedValidationError(Exception):
+    pass
+
+
+def file_sha256(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024*1024), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def check_cwl(filePath, acl_entities=None):
+    """
+    Checks that a merged CWL file is well formed and that its workflow uses
+    the challenge inputs and outputs, see cwl_checker.check_merged_workflow
+    """
+    try:
+        #test = subprocess.check_call(["cwltool", "--print-pre", filePath])
+        test = os.system("cwltool --print-pre %s" % filePath)
+    except Exception as e:
+        raise ValueError("Your CWL file is not formatted correctly",e)
+
+    return cwl_checker.check_merged_cwl(filePath, acl_entities, merge_hint=MERGE_HINT)
+
+
+def write_cached_result(cache_path, result):
+    """
+    Cache a check_cwl result. Submissions are validated concurrently, each
+    writes its own temporary file then renames it, so that a partial result
+    is never read. The cache is only an optimisation, failing to write it
+    does not fail the validation.
+    """
+    try:
+        if not os.path.isdir(CWL_VALIDATION_CACHE_DIR):
+            os.makedirs(CWL_VALIDATION_CACHE_DIR)
+        fd, tmp_path = tempfile.mkstemp(dir=CWL_VALIDATION_CACHE_DIR, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(result, f)
+        os.rename(tmp_path, cache_path)
+    except (IOError, OSError) as e:
+        print "Unable to cache the CWL validation result in %s: %s" % (cache_path, e)
+
+
+def check_cwl_cached(filePath, acl_entities):
+    """
+    check_cwl, with its result cached by the hash of the file and
+    CWL_VALIDATOR_VERSION. A cached failure raises CachedValidationError
+    with the message of the original failure. The synData entities found,
+    before the failure if there is one, are appended to acl_entities.
+    """
+    cache_path = os.path.join(CWL_VALIDATION_CACHE_DIR, "%s-%s.json" % (file_sha256(filePath), CWL_VALIDATOR_VERSION))
+    if os.path.exists(cache_path):
+        with open(cache_path) as f:
+            result = json.load(f)
+        if not result['valid']:
+            acl_entities.extend(result['acl_entities'])
+            raise CachedValidationError(result['message'])
+        acl_entities.extend(result['summary']['acl_entities'])
+        return result['summary']
+    found = []
+    try:
+        summary = check_cwl(filePath, found)
+        result = {'valid': True, 'summary': summary}
+    except (IOError, OSError):
+        ## not about the content of the file, don't cache
+        raise
+    except Exception as e:
+        summary = None
+        result = {'valid': False, 'message': str(e), 'acl_entities': found}
+    acl_entities.extend(found)
+    write_cached_result(cache_path, result)
+    if not result['valid']:
+        raise CachedValidationError(result['message'])
+    return summary
+
+
+def clear_acl_cache():
+    with acl_cache_lock:
+        acl_cache.clear()
+
+
+def admin_can_read(syn, entity):
+    """False if the ACL of the entity denies READ to the admin team"""
+    indexFiles = syn.get(entity,downloadFile=False)
+    acls = syn._getACL(indexFiles)
+    for acl in acls['resourceAccess']:
+        if acl['principalId'] == CHALLENGE_ADMIN_TEAM_ID:
+            if 'READ' not in acl['accessType']:
+                return False
+    return True
+
+
+def check_acls(syn, entities):
+    """
+    Check that the admin team can read all the entities. The entities not
+    checked yet in this validation run are looked up concurrently.
+    """
+    with acl_cache_lock:
+        todo = list(set(entity for entity in entities if entity not in acl_cache))
+    if len(todo) > 0:
+        pool = ThreadPool(min(ACL_WORKERS, len(todo)))
+        try:
+            readable = pool.map(lambda entity: admin_can_read(syn, entity), todo)
+        finally:
+            pool.close()
+            pool.join()
+        with acl_cache_lock:
+            acl_cache.update(zip(todo, readable))
+    for entity in entities:
+        assert acl_cache[entity], "At least View/READ access has to be given to the SMC_RNA_Admins Team: (Team ID: 3322844)"
+
+
 ## Testing link validation: 7155824
 def validate(evaluation,submission,syn,token):
     assert isinstance(submission.entity, synapseclient.File), "Must submit a file entity"
     if submission.entity.externalURL is None:
+        acl_entities = []
         try:
-            #test = subprocess.check_call(["cwltool", "--print-pre", submission.filePath])
-            test = os.system("cwltool --print-pre %s" % submission.filePath)
-        except Exception as e:
-            raise ValueError("Your CWL file is not formatted correctly",e)
-
-        with open(submission.filePath,"r") as cwlfile:
-            try:
-                docs = yaml.load(cwlfile)
-            except Exception as e:
-                raise Exception("Must be a CWL file (Yaml format)")
-        version = docs['cwlVersion']
-        assert version in  ['v1.0','draft-3'], "cwlVersion must be draft-3 or v1.0"
-        if docs.get('$graph',None) is None:
-            raise ValueError("Please run 'python smc_rna_submit.py merge --CWLfile %s'" % submission.filePath)
-        else:
-            requiredInputs = []
-            cwltools = []
-            workflowinputs = []
-            workflowoutputs = []
-            merged = docs['$graph']
-            custom_inputs = dict()
-            for tools in merged:
-                if tools['class'] == 'CommandLineTool':
-                    for i in tools['inputs']:
-                        cwltools.append("%s/%s" % ("input",i['id']))
-                    for i in tools['outputs']:
-                        cwltools.append("%s/%s" % ("output",i['id']))
-                else:
-                    #Check: Workflow class
-                    assert tools['class'] == 'Workflow', 'CWL Classes can only be named "Workflow" or "CommandLineTool'
-                    workflow = tools
-            #Check: Make sure hints for index files are formatted correctly
-            hints = workflow.get("hints",None)
-            if hints is not None:
-                for i in hints:
-                    if os.path.basename(i['class']) == "synData":
-                        assert i.get('input', None) is not None or \
-                               i.get('entity', None) is not None, """synData hint must be in this format:
-                                                                                hints:
-                                                                                  - class: synData
-                                                                                    input: index
-                                                                                    entity: syn12345
-                                                                  """
-                        custom_inputs[i['input']] = i['entity']
-
-            for i in workflow['inputs']:
-                workflowinputs.append("%s" % i['id'])
-                if os.path.basename(i['id']) not in PROVIDED:
-                    assert custom_inputs.get(os.path.basename(i['id']),None) is not None, "Custom inputs do not match hints"
-                    #Check: if synData is used, they must have the correct ACL's
-                    indexFiles = syn.get(custom_inputs.get(os.path.basename(i['id']),None),downloadFile=False)
-                    acls = syn._getACL(indexFiles)
-                    for acl in acls['resourceAccess']:
-                        if acl['principalId'] == CHALLENGE_ADMIN_TEAM_ID:
-                            assert 'READ' in acl['accessType'], "At least View/READ access has to be given to the SMC_RNA_Admins Team: (Team ID: 3322844)"
-
-            #Check: Must contain at least tumor fastq1, 2 as inputs in workflow step
-            for i in ["TUMOR_FASTQ_1","TUMOR_FASTQ_2"]:
-                required = "#main/%s" % i
-                assert required in workflowinputs, "Your workflow MUST contain at least these two inputs: 'TUMOR_FASTQ_1','TUMOR_FASTQ_2'"
-            #Check: If all workflow inputs map to the custom or provided ids
-            if len(workflowinputs) > (len(custom_inputs) + 2):
-                for i in workflowinputs:
-                    assert os.path.basename(i) in PROVIDED or os.path.basename(i) in custom_inputs, "Your specified input ids must be one of: %s" %  ", ".join(custom_inputs.keys()+PROVIDED)
-            for i in workflow['steps']:
-                #Check for v1.0 and draft-3
-                if version == "draft-3":
-                    inputs = "inputs"
-                    outSource = "source"
-                    for y in i['outputs']:
-                        workflowoutputs.append(y['id'])
-                else:
-                    inputs = "in"
-                    outSource = "outputSource"
-                    for y in i['out']:
-                        workflowoutputs.append(y)
-                workflowinputs = workflowinputs + workflowoutputs
-            #Must seperate the input and output colleciton steps
-            for i in workflow['steps']:
-                for y in i[inputs]:
-                    #Check: Workflow tool steps match the cwltools inputs
-                    if isinstance(i['run'],str):
-                        steps = "%s/#%s/%s" % ("input",i['run'][1:],os.path.basename(y['id']))
-                        assert steps in cwltools, 'Your tool inputs do not match your workflow inputs'
-                    #Check: All sources used are included in the workflow inputs
-                    if 'source' in y:
-                        y['source'] = [y['source']] if isinstance(y['source'],str) else y['source']
-                        assert all([source in workflowinputs for source in y['source']]), 'Not all of your inputs in your workflow are mapped'
-            for i in workflow['outputs']:
-                assert i['id'] == '#main/OUTPUT', "Your workflow output id must be OUTPUT"
-                #Check: All outputs have the correct sources mapped
-                if outSource in i:
-                    assert i[outSource] in workflowoutputs, 'Your workflow output is not mapped correctly to your tools'
+            check_cwl_cached(submission.filePath, acl_entities)
+        finally:
+            #Check: if synData is used, they must have the correct ACL's
+            #(those found before a failed check come before its error)
+            check_acls(syn, acl_entities)
     else:
         assert submission.entity.externalURL.startswith('https://cgc.sbgenomics.com/u'), "Your input URL is not formatted correctly"
         BASE_URL = "https://cgc-api.sbgenomics.com/v2/"
@@ -197,6 +250,10 @@ def score(evaluation,submission):
     return(dict(),"Thank you for your submission to the SMC-RNA Challenge!")
 
 
+## 'scoring_workers' is how many submissions of a queue are scored at the
+## same time, defaults to SCORING_WORKERS
+SCORING_WORKERS = 1
+
 config_evaluations = [
 
     {
@@ -204,6 +261,7 @@ config_evaluations = [
         'score_as_part_of_challenge': False,
         'validation_function': validate,
         'scoring_function': score,
+        'scoring_workers': 4,
 
     },
     {
@@ -211,6 +269,7 @@ config_evaluations = [
         'score_as_part_of_challenge': False,
         'validation_function': validate,
         'scoring_function': score,
+        'scoring_workers': 4,
 
     }
 ]
@@ -232,6 +291,14 @@ def validate_submission(evaluation, submission, token):
     return results
 
 
+def scoring_workers(evaluation):
+    """
+    Number of processes that score the submissions of an evaluation queue
+    """
+    config = config_evaluations_map[int(evaluation.id)]
+    return max(1, config.get('scoring_workers', SCORING_WORKERS))
+
+
 def score_submission(evaluation, submission):
     """
     Find the right scoring function and score the submission
@@ -4,34 +4,70 @@ import inspect
 import os
 import shutil
 import sys
+import threading
 import time
 from datetime import timedelta
 
 LOCK_DEFAULT_MAX_AGE = timedelta(hours=2)
 
+## A lock with a heartbeat is refreshed this often while it's held, so its
+## max_age only needs to cover a few missed heartbeats
+LOCK_DEFAULT_HEARTBEAT = timedelta(minutes=1)
+
 
 class LockedException(Exception):
     pass
 
-def acquire_lock_or_fail(name, max_age=LOCK_DEFAULT_MAX_AGE):
-    lock = Lock(name, max_age=max_age)
+def acquire_lock_or_fail(name, max_age=LOCK_DEFAULT_MAX_AGE, heartbeat=LOCK_DEFAULT_HEARTBEAT):
+    lock = Lock(name, max_age=max_age, heartbeat=heartbeat)
     if lock.acquire():
         return lock
     raise LockedException("A lock exists named %s who's age is: %s" % (name, unicode(lock.get_age())))
 
 
+def acquire_locks_or_fail(names, max_age=LOCK_DEFAULT_MAX_AGE, heartbeat=LOCK_DEFAULT_HEARTBEAT):
+    """
+    Acquire all the named locks or none of them.
+
+    :returns: the list of locks, to be released by the caller
+    """
+    locks = []
+    try:
+        for name in names:
+            locks.append(acquire_lock_or_fail(name, max_age=max_age, heartbeat=heartbeat))
+    except LockedException:
+        for lock in locks:
+            lock.release()
+        raise
+    return locks
+
+
+def lock_name(phase, queue=None):
+    """Name of the lock of a phase of the scoring script, for one queue or for all"""
+    if queue is None:
+        return "challenge.%s" % phase
+    return "challenge.%s.%s" % (phase, queue)
+
+
 class Lock(object):
     """
     Implements a lock by making a directory named [lockname].lock
+
+    With a heartbeat, a thread touches the directory at that interval while
+    the lock is held, so that the lock only looks older than max_age, and
+    gets broken, once its holder is gone.
     """
     SUFFIX = 'lock'
 
-    def __init__(self, name, dir=None, max_age=LOCK_DEFAULT_MAX_AGE):
+    def __init__(self, name, dir=None, max_age=LOCK_DEFAULT_MAX_AGE, heartbeat=None):
         self.name = name
         self.held = False
         self.dir = dir if dir else os.getcwd()
         self.lock_dir_path = os.path.join(self.dir, ".".join([name, Lock.SUFFIX]))
         self.max_age = max_age
+        self.heartbeat = heartbeat
+        self.heartbeat_thread = None
+        self.stopped = threading.Event()
 
     def get_age(self):
         return timedelta(seconds=time.time() - os.path.getmtime(self.lock_dir_path))
@@ -56,10 +92,29 @@ class Lock(object):
                 os.utime(self.lock_dir_path, (0, time.time()))
             else:
                 self.held = False
+        if self.held and self.heartbeat:
+            self.start_heartbeat()
         return self.held
 
+    def start_heartbeat(self):
+        self.stopped.clear()
+        self.heartbeat_thread = threading.Thread(target=self.beat, name="heartbeat of %s lock" % self.name)
+        self.heartbeat_thread.daemon = True
+        self.heartbeat_thread.start()
+
+    def beat(self):
+        while not self.stopped.wait(self.heartbeat.total_seconds()):
+            try:
+                os.utime(self.lock_dir_path, None)
+            except OSError as err:
+                sys.stderr.write("Can't refresh %s lock: %s\n" % (self.name, err))
+
     def release(self):
         """Release lock or do nothing if lock is not held"""
+        if self.heartbeat_thread is not None:
+            self.stopped.set()
+            self.heartbeat_thread.join()
+            self.heartbeat_thread = None
         if self.held:
             try:
                 shutil.rmtree(self.lock_dir_path)
@@ -80,7 +135,7 @@ def _sleep(seconds=0):
 
 
 if __name__ == "__main__":
-    lock = acquire_lock_or_fail('foo', max_age=timedelta(seconds=10))
+    lock = acquire_lock_or_fail('foo', max_age=timedelta(seconds=10), heartbeat=timedelta(seconds=2))
     try:
         parser = argparse.ArgumentParser()
 
@@ -0,0 +1,77 @@
+## Cache of the names of Synapse users and teams for the scoring script.
+
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+NAME_CACHE_DEFAULT_TTL = timedelta(days=1)
+NAME_CACHE_DEFAULT_MAX_ENTRIES = 1000
+
+
+class NameCache(object):
+    """
+    Keeps names in a small SQLite file, so that they survive from one run of
+    the scoring script to the next, and the most recently used ones in
+    memory. A name older than ttl is fetched again.
+
+    Can be shared by threads.
+    """
+
+    def __init__(self, path, ttl=NAME_CACHE_DEFAULT_TTL, max_entries=NAME_CACHE_DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl.total_seconds()
+        self.max_entries = max_entries
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.db:
+            self.db.execute("create table if not exists names (key text primary key, name text, fetched real)")
+            self.db.execute("delete from names where fetched < ?", (time.time() - self.ttl,))
+
+    def get(self, key, fetch):
+        """
+        Return the name cached for key, or call fetch() to get it and cache
+        it. Names are not cached if fetch() raises.
+        """
+        now = time.time()
+        with self.lock:
+            if key in self.memory:
+                name, fetched = self.memory.pop(key)
+                if fetched >= now - self.ttl:
+                    self.memory[key] = (name, fetched)
+                    return name
+            row = self.db.execute("select name, fetched from names where key=?", (key,)).fetchone()
+            if row is not None and row[1] >= now - self.ttl:
+                self.remember(key, row[0], row[1])
+                return row[0]
+
+        ## fetch without holding the lock, so that other threads carry on
+        name = fetch()
+        with self.lock:
+            with self.db:
+                self.db.execute("insert or replace into names (key, name, fetched) values (?, ?, ?)", (key, name, now))
+            self.remember(key, name, now)
+        return name
+
+    def remember(self, key, name, fetched):
+        self.memory[key] = (name, fetched)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def invalidate(self, key=None):
+        """Forget the name cached for key, or all names if key is None"""
+        with self.lock:
+            with self.db:
+                if key is None:
+                    self.memory.clear()
+                    self.db.execute("delete from names")
+                else:
+                    self.memory.pop(key, None)
+                    self.db.execute("delete from names where key=?", (key,))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
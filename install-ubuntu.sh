@@ -11,6 +11,7 @@ fi
 
 sudo pip install cwltool cwl-runner
 sudo pip install synapseclient
+sudo pip install crcmod
 git clone https://github.com/Sage-Bionetworks/SMC-RNA-Examples.git
 
 docker pull dreamchallenge/smcrna-functions
@@ -0,0 +1,125 @@
+#
+# Structural checks of merged CWL workflows, shared by smc_rna_submit.py on
+# the participant side and challenge/challenge_config.py on the server, so
+# that both give the same verdict.
+#
+# The tool and workflow ids are kept in sets, each lookup is O(1) and a
+# workflow with hundreds of steps is checked in linear time.
+#
+# The ACLs of synData entities are checked by the callers, the entities are
+# collected in the list they pass in, so that those found before a failed
+# check can be checked first, as when the checks ran inline.
+
+import os
+import yaml
+
+PROVIDED = ["TUMOR_FASTQ_1","TUMOR_FASTQ_2","REFERENCE_GENOME","REFERENCE_GTF"]
+MERGE_HINT = "Please run 'python smc_rna_submit.py merge %s'"
+
+
+def load_merged_cwl(filePath, merge_hint=MERGE_HINT):
+    with open(filePath,"r") as cwlfile:
+        try:
+            docs = yaml.load(cwlfile)
+        except Exception as e:
+            raise Exception("Must be a CWL file (Yaml format)")
+    version = docs['cwlVersion']
+    assert version in  ['v1.0','draft-3'], "cwlVersion must be draft-3 or v1.0"
+    if docs.get('$graph',None) is None:
+        raise ValueError(merge_hint % filePath)
+    return docs
+
+
+def check_merged_workflow(docs, acl_entities=None):
+    """
+    Checks that the workflow of a merged CWL document uses the challenge
+    inputs and outputs, raises AssertionError otherwise.
+
+    :param acl_entities: a list the synData entities the admin team needs
+                         READ access to are appended to as they are found
+    :returns: a summary of the workflow, its synData 'custom_inputs' and the
+              'acl_entities'
+    """
+    version = docs['cwlVersion']
+    cwltools = set()
+    workflowinputs = set()
+    workflowoutputs = set()
+    custom_inputs = dict()
+    if acl_entities is None:
+        acl_entities = []
+    for tools in docs['$graph']:
+        if tools['class'] == 'CommandLineTool':
+            for i in tools['inputs']:
+                cwltools.add("%s/%s" % ("input",i['id']))
+            for i in tools['outputs']:
+                cwltools.add("%s/%s" % ("output",i['id']))
+        else:
+            #Check: Workflow class
+            assert tools['class'] == 'Workflow', 'CWL Classes can only be named "Workflow" or "CommandLineTool'
+            workflow = tools
+    #Check: Make sure hints for index files are formatted correctly
+    hints = workflow.get("hints",None)
+    if hints is not None:
+        for i in hints:
+            if os.path.basename(i['class']) == "synData":
+                assert i.get('input', None) is not None or \
+                       i.get('entity', None) is not None, """synData hint must be in this format:
+                                                                        hints:
+                                                                          - class: synData
+                                                                            input: index
+                                                                            entity: syn12345
+                                                          """
+                custom_inputs[i['input']] = i['entity']
+
+    for i in workflow['inputs']:
+        workflowinputs.add("%s" % i['id'])
+        if os.path.basename(i['id']) not in PROVIDED:
+            assert custom_inputs.get(os.path.basename(i['id']),None) is not None, "Custom inputs do not match hints"
+            #Check: if synData is used, they must have the correct ACL's
+            acl_entities.append(custom_inputs.get(os.path.basename(i['id']),None))
+
+    #Check: Must contain at least tumor fastq1, 2 as inputs in workflow step
+    for i in ["TUMOR_FASTQ_1","TUMOR_FASTQ_2"]:
+        required = "#main/%s" % i
+        assert required in workflowinputs, "Your workflow MUST contain at least these two inputs: 'TUMOR_FASTQ_1','TUMOR_FASTQ_2'"
+    #Check: If all workflow inputs map to the custom or provided ids
+    if len(workflow['inputs']) > (len(custom_inputs) + 2):
+        for i in workflowinputs:
+            assert os.path.basename(i) in PROVIDED or os.path.basename(i) in custom_inputs, "Your specified input ids must be one of: %s" %  ", ".join(custom_inputs.keys()+PROVIDED)
+    #Check for v1.0 and draft-3
+    if version == "draft-3":
+        inputs = "inputs"
+        outSource = "source"
+    else:
+        inputs = "in"
+        outSource = "outputSource"
+    for i in workflow['steps']:
+        if version == "draft-3":
+            for y in i['outputs']:
+                workflowoutputs.add(y['id'])
+        else:
+            for y in i['out']:
+                workflowoutputs.add(y)
+    #The outputs of every step can be the sources of any step
+    workflowinputs.update(workflowoutputs)
+    for i in workflow['steps']:
+        for y in i[inputs]:
+            #Check: Workflow tool steps match the cwltools inputs
+            if isinstance(i['run'],basestring):
+                steps = "%s/#%s/%s" % ("input",i['run'][1:],os.path.basename(y['id']))
+                assert steps in cwltools, 'Your tool inputs do not match your workflow inputs'
+            #Check: All sources used are included in the workflow inputs
+            if 'source' in y:
+                y['source'] = [y['source']] if isinstance(y['source'],basestring) else y['source']
+                assert all([source in workflowinputs for source in y['source']]), 'Not all of your inputs in your workflow are mapped'
+    for i in workflow['outputs']:
+        assert i['id'] == '#main/OUTPUT', "Your workflow output id must be OUTPUT"
+        #Check: All outputs have the correct sources mapped
+        if outSource in i:
+            assert i[outSource] in workflowoutputs, 'Your workflow output is not mapped correctly to your tools'
+    return {'custom_inputs': custom_inputs, 'acl_entities': acl_entities}
+
+
+def check_merged_cwl(filePath, acl_entities=None, merge_hint=MERGE_HINT):
+    """Load a merged CWL file and check its workflow, see check_merged_workflow"""
+    return check_merged_workflow(load_merged_cwl(filePath, merge_hint), acl_entities)
@@ -0,0 +1,178 @@
+#
+# Runs cwl-runner for dream_runner.py and reports what happened.
+#
+# The log of cwl-runner is passed through as it is written, and each
+# "[job <name>] ..." line of cwltool is used to time the steps of the
+# workflow: a step runs from its first line to its "completed" line, and its
+# peak memory is taken from the "Max memory used" line cwltool writes for
+# tools that do not run in docker. The cpu time and peak RSS of the whole
+# run, cwl-runner and the processes it waited for, come from wait4().
+
+from __future__ import print_function
+
+import os
+import re
+import sys
+import json
+import time
+import threading
+import subprocess
+from collections import OrderedDict
+
+JOB_LINE = re.compile(r'^\[job ([^\]]+)\] (.*)$')
+COMPLETED = re.compile(r'^completed (\w+)')
+MAX_MEMORY = re.compile(r'^Max memory used: (\d+)MiB')
+
+
+class CwlStep(object):
+    """A job of a cwl-runner run, as told by its log"""
+
+    def __init__(self, name, start):
+        self.name = name
+        self.start = start
+        self.end = None
+        self.status = "running"
+        self.max_memory = None      #MiB, when cwltool reports it
+
+    @property
+    def wall(self):
+        if self.end is None:
+            return None
+        return self.end - self.start
+
+
+class CwlResult(object):
+    """
+    The outcome of a cwl-runner run: ok is False if it failed, with the
+    reason in error. outputs is the output object printed by cwl-runner.
+    """
+
+    def __init__(self, tool, arguments):
+        self.tool = tool
+        self.arguments = arguments
+        self.returncode = None
+        self.outputs = None
+        self.error = None
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.max_rss = 0            #KiB
+        self.steps = OrderedDict()
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    @property
+    def output_path(self):
+        """Path of the OUTPUT file of the workflow, None if it failed"""
+        if not self.ok:
+            return None
+        return self.outputs['OUTPUT']['path']
+
+    def summary(self):
+        lines = ["step\tstatus\tseconds\tmax_memory_mb"]
+        for step in self.steps.values():
+            lines.append("%s\t%s\t%s\t%s" % (step.name, step.status,
+                                             "" if step.wall is None else "%.0f" % step.wall,
+                                             "" if step.max_memory is None else step.max_memory))
+        lines.append("total\t%s\t%.0f\t%.0f" % ("success" if self.ok else "failed",
+                                               self.wall, self.max_rss / 1024.0))
+        lines.append("cpu seconds: %.0f" % self.cpu)
+        return "\n".join(lines)
+
+
+def parse_log_line(result, line, now):
+    match = JOB_LINE.match(line)
+    if match is None:
+        return
+    name, message = match.groups()
+    step = result.steps.get(name)
+    if step is None:
+        step = result.steps[name] = CwlStep(name, now)
+    completed = COMPLETED.match(message)
+    if completed is not None:
+        step.end = now
+        step.status = completed.group(1)
+    memory = MAX_MEMORY.match(message)
+    if memory is not None:
+        step.max_memory = int(memory.group(1))
+
+
+def encode(text):
+    if isinstance(text, bytes):
+        return text
+    return text.encode("utf-8")
+
+
+def read_all(stream, out):
+    out.append(stream.read())
+
+
+def run_cwl(tool, arguments, label=None):
+    """
+    Run cwl-runner with arguments, printing its log live to stderr with
+    label in front of each line, and return a CwlResult.
+    """
+    result = CwlResult(tool, arguments)
+    start = time.time()
+    try:
+        process = subprocess.Popen(arguments, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as e:
+        result.error = "Unable to call cwl-runner: %s" % e
+        return result
+
+    #stdout is read by a thread, so that neither pipe fills up
+    stdout = []
+    reader = threading.Thread(target=read_all, args=(process.stdout, stdout))
+    reader.daemon = True
+    reader.start()
+    #the log is passed through as bytes, it can hold anything and stderr
+    #may not be a terminal that takes unicode
+    prefix = b"" if label is None else b"[" + encode(label) + b"] "
+    log = getattr(sys.stderr, "buffer", sys.stderr)
+    reaped = False
+    try:
+        for line in iter(process.stderr.readline, b""):
+            if not line.endswith(b"\n"):
+                line += b"\n"
+            log.write(prefix + line)
+            log.flush()
+            parse_log_line(result, line.decode("utf-8", "replace").rstrip("\r\n"), time.time())
+        reader.join()
+        pid, status, usage = os.wait4(process.pid, 0)
+        reaped = True
+    finally:
+        if not reaped:
+            #don't leave cwl-runner running with nobody reading its pipes
+            try:
+                process.kill()
+            except OSError:
+                pass
+            os.wait4(process.pid, 0)
+            reader.join()
+        process.stderr.close()
+        process.stdout.close()
+
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    result.returncode = process.returncode
+    result.wall = time.time() - start
+    result.cpu = usage.ru_utime + usage.ru_stime
+    result.max_rss = usage.ru_maxrss
+
+    failed = [step.name for step in result.steps.values() if step.status not in ("success", "running")]
+    try:
+        result.outputs = json.loads(stdout[0].decode("utf-8"))
+    except ValueError:
+        result.outputs = None
+    if result.returncode != 0:
+        result.error = "cwl-runner exited with status %d" % result.returncode
+    elif not isinstance(result.outputs, dict):
+        result.error = "cwl-runner did not print its outputs"
+    elif not isinstance(result.outputs.get('OUTPUT'), dict):
+        result.error = "The workflow has no OUTPUT"
+    if result.error is not None and failed:
+        result.error += ", failed steps: %s" % ", ".join(failed)
+    return result
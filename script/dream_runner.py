@@ -4,6 +4,7 @@ from __future__ import print_function
 
 import re
 import os
+import copy
 import yaml
 import shutil
 import argparse
@@ -14,6 +15,12 @@ import synapseclient
 import sys
 import json
 import getpass
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import fetcher
+import cwl_runner
+import refstore
 from sys import argv
 
 DREAM_RNA_BUCKET = "gs://dream-smc-rna"
@@ -25,6 +32,13 @@ REFERENCE_DATA = {
 
 FILE_SUFFIX = ["_filtered.bedpe", "_isoforms_truth.txt", "_mergeSort_1.fq.gz", "_mergeSort_2.fq.gz"]
 
+#Resources of a test-matrix workflow run when its CWL has no ResourceRequirement,
+#and of an evaluation run (memory in MB)
+MATRIX_DEFAULT_CPUS = 4
+MATRIX_DEFAULT_MEMORY = 16384
+EVALUATION_CPUS = 1
+EVALUATION_MEMORY = 4096
+
 def synapse_login():
     try:
         syn = synapseclient.login()
@@ -55,25 +69,26 @@ def find_synapse_data(cwl):
     input = filter(lambda input: input.get('class', None) == "Workflow", cwl['$graph'])[0]
     return input['hints'][0]['entity']
 
-def call_cwl(tool, inputs, nocache=False, cachedir = "cwl-cache"):
-    if nocache:
-        arguments = ["cwl-runner",tool]
-    else:
-        arguments = ["cwl-runner",
-                     "--cachedir", cachedir,
-                     tool]
+def call_cwl(tool, inputs, nocache=False, cachedir = "cwl-cache", outdir=None, label=None):
+    """
+    Runs cwl-runner on a tool, returns a cwl_runner.CwlResult, see
+    cwl_runner.run_cwl. The log of each step is printed as it comes.
+    """
+    arguments = ["cwl-runner"]
+    if not nocache:
+        arguments.extend(["--cachedir", cachedir])
+    if outdir is not None:
+        arguments.extend(["--outdir", outdir])
+    arguments.append(tool)
     arguments.extend(inputs)
-    try:
-        print("Running: %s" % (" ".join(arguments)))
-        process = subprocess.Popen(arguments, stdout=subprocess.PIPE)
-        output, error = process.communicate()
-        temp = json.loads(output)
-        print(temp)
-        return(temp['OUTPUT']['path'])
-    except Exception, e:
-        traceback.print_exc()
-        print("Unable to call cwltool")
-    #return(temp['output']['path'])
+    print("Running: %s" % (" ".join(arguments)))
+    result = cwl_runner.run_cwl(tool, arguments, label)
+    if result.outputs is not None:
+        print(json.dumps(result.outputs, indent=4))
+    print(result.summary(), file=sys.stderr)
+    if not result.ok:
+        print("%s failed: %s" % (tool, result.error), file=sys.stderr)
+    return result
 
 def call_workflow(cwl, fastq1, fastq2, index_path, nocache=False, cachedir="cwl-cache"):
     inputs = ["--index", index_path,
@@ -83,7 +98,7 @@ def call_workflow(cwl, fastq1, fastq2, index_path, nocache=False, cachedir="cwl-
     output = call_cwl(cwl, inputs, nocache, cachedir)
     return(output)
 
-def call_evaluation(cwl, workflow_output, truth, annotations, nocache=False, cachedir="cwl-cache"):
+def call_evaluation(cwl, workflow_output, truth, annotations, nocache=False, cachedir="cwl-cache", outdir=None, label=None):
     # local = "eval-workflow.cwl"
     # shutil.copyfile(cwl, local)
     inputs = ["--input", workflow_output,
@@ -91,7 +106,7 @@ def call_evaluation(cwl, workflow_output, truth, annotations, nocache=False, cac
     if annotations is not None:
         inputs.extend(["--gtf", annotations])
 
-    call_cwl(cwl, inputs, nocache, cachedir)
+    return call_cwl(cwl, inputs, nocache, cachedir, outdir, label)
     # os.remove(local)
 
 def run_dream(synapse, args):
@@ -105,36 +120,91 @@ def run_dream(synapse, args):
     # index = synapse.get(synapse_id, downloadLocation="/data")
     index = synapse.get(synapse_id)
     workflow_out = call_workflow(args.workflow_cwl, args.fastq1, args.fastq2, index.path)
-    call_evaluation(args.eval_cwl, workflow_out, args.truth, args.annotations)
+    if not workflow_out.ok:
+        raise ValueError("Your workflow failed: %s" % workflow_out.error)
+    call_evaluation(args.eval_cwl, workflow_out.output_path, args.truth, args.annotations)
 
-def download(synapse,args):
+def check_bucket():
+    if not fetcher.is_gs(DREAM_RNA_BUCKET):
+        if not os.path.isdir(DREAM_RNA_BUCKET):
+            raise ValueError("%s is not a directory" % DREAM_RNA_BUCKET)
+        return
     try:
         subprocess.check_call(["gsutil", "ls" ,DREAM_RNA_BUCKET])
     except Exception as e:
         raise ValueError("You are not logged in to gcloud.  Please login by doing 'gcloud auth login' and follow the steps to have access to the google bucket")
+
+def dataset_files(args):
+    if args.input.startswith("sim"):
+        data = "training/%s_*" % (args.input)
+    elif args.input.startswith("dryrun"):
+        data = "debugging/%s_*" % (args.input)
+    else:
+        raise ValueError("Training/debugging datasets start with 'sim' or 'dryrun'")
+    objects = fetcher.list_objects(DREAM_RNA_BUCKET, data, manifest=fetch_manifest(args))
+    if len(objects) == 0:
+        raise ValueError("No files found for %s" % args.input)
+    return [(name, remote, os.path.join(args.dir, os.path.basename(name)), False) for name, remote in sorted(objects.items())]
+
+def reference_files(args):
+    out = []
+    manifest = fetch_manifest(args)
+    for ref in REFERENCE_DATA.values():
+        objects = fetcher.list_objects(DREAM_RNA_BUCKET, "%s.gz" % (ref), manifest=manifest)
+        if len(objects) == 0:
+            raise ValueError("%s.gz not found in %s" % (ref, DREAM_RNA_BUCKET))
+        for name, remote in objects.items():
+            out.append((name, remote, os.path.join(args.dir, ref), True))
+    return out
+
+def reference_store(args):
+    if args.no_store:
+        return None
+    return refstore.RefStore(args.store, int(args.store_size * 1024 ** 3))
+
+def fetch_manifest(args):
+    return fetcher.Manifest(os.path.join(args.dir, fetcher.MANIFEST_NAME))
+
+def fetch(args, files):
+    if not os.path.exists(args.dir):
+        os.makedirs(args.dir)
+    fetcher.fetch_all(DREAM_RNA_BUCKET, files, fetch_manifest(args), args.workers, reference_store(args))
+
+def synapse_file(syn, entity, args):
+    """Path of a Synapse file, linked from the reference store into args.dir"""
+    store = reference_store(args)
+    if store is None:
+        return syn.get(entity).path
+    ent = syn.get(entity, downloadFile=False)
+    key = "synapse:%s.%s" % (ent.id, ent.versionNumber)
+    dirname = os.path.abspath(os.path.join(args.dir, "synapse", "%s.%s" % (ent.id, ent.versionNumber)))
+    dest = os.path.join(dirname, ent.name)
+    refstore.makedirs(dirname)
+    if store.link(key, dest):
+        return dest
+    ent = syn.get(entity, version=ent.versionNumber, downloadLocation=dirname)
+    if ent.path != dest:
+        os.rename(ent.path, dest)
+    store.add(key, dest)
+    return dest
+
+def download(synapse,args):
+    check_bucket()
     print("Caching Inputs files", file=sys.stderr)
-    for suf in FILE_SUFFIX:
-        local_path = os.path.join(args.dir, args.input + suf)
-        if not os.path.exists(local_path):
-            if args.input.startswith("sim"):
-                data = "%s/training/%s_*" % (DREAM_RNA_BUCKET, args.input)
-            elif args.input.startswith("dryrun"):
-                data = "%s/debugging/%s_*" % (DREAM_RNA_BUCKET, args.input)                    
-            cmd = ["gsutil","cp", data, args.dir]
-            subprocess.check_call(cmd)
-
-def gen_inputs(syn,args):
+    fetch(args, dataset_files(args))
+
+def gen_inputs(syn,args,fetch_data=True):
     with open(args.workflow) as handle:
         doc = yaml.load(handle.read())
     custom_inputs = {}
     for hint in doc.get("hints", []):
         if 'synData' == hint.get("class", ""):
-            ent = syn.get(hint['entity'])
             custom_inputs[hint['input']] = {
                 "class" : "File",
-                "path" : ent.path
+                "path" : synapse_file(syn, hint['entity'], args)
             }
-    download(syn, args)
+    if fetch_data:
+        download(syn, args)
     in_req = {
         "TUMOR_FASTQ_1" : {
             "class" : "File",
@@ -155,63 +225,242 @@ def gen_inputs(syn,args):
     return in_req
 
 def run_test(syn,args):
-    try:
-        subprocess.check_call(["gsutil", "ls" ,DREAM_RNA_BUCKET])
-    except Exception as e:
-        raise ValueError("You are not logged in to gcloud.  Please login by doing 'gcloud auth login' and follow the steps to have access to the google bucket")
+    check_bucket()
     if not os.path.exists(args.dir):
         print("Making directory %s" % args.dir, file=sys.stderr)
         os.mkdir(args.dir)
 
-    for ref in REFERENCE_DATA.values():
-        if not os.path.exists(os.path.join(args.dir, ref)):
-            cmd = ["gsutil", "cp", "%s/%s.gz" % (DREAM_RNA_BUCKET, ref), args.dir]
-            subprocess.check_call(cmd)
-            cmd = ["gunzip", os.path.join(args.dir, "%s.gz" % (ref))]
-            subprocess.check_call(cmd)
-        
-    in_req = gen_inputs(syn,args)
+    #The references are decompressed as they download, alongside the inputs
+    print("Caching Reference and Inputs files", file=sys.stderr)
+    fetch(args, reference_files(args) + dataset_files(args))
+
+    evaluations = evaluation_runs(syn, args)
+    in_req = gen_inputs(syn,args,fetch_data=False)
     print(json.dumps(in_req, indent=4))
-        
-    tmp = tempfile.NamedTemporaryFile(dir=args.dir, prefix="dream_runner_input_", suffix=".json", delete=False)
+
+    input_json = write_inputs(args.dir, in_req)
+    workflow_out = call_cwl(args.workflow, [input_json], args.no_cache, cachedir=args.cachedir)
+    if not workflow_out.ok:
+        raise ValueError("Your workflow failed: %s" % workflow_out.error)
+    for name, cwl, truth, annotations in evaluations:
+        call_evaluation(cwl, workflow_out.output_path, truth, annotations, args.no_cache, cachedir=args.cachedir)
+
+def write_inputs(dir, in_req):
+    tmp = tempfile.NamedTemporaryFile(dir=dir, prefix="dream_runner_input_", suffix=".json", delete=False)
     tmp.write(json.dumps(in_req))
     tmp.close()
-    workflow_out = call_cwl(args.workflow, [tmp.name], args.no_cache, cachedir=args.cachedir)
+    return tmp.name
+
+def evaluation_runs(syn, args):
+    """
+    The evaluations of the challenge, (name, cwl, truth, annotations) of each
+    """
     if args.challenge == "fusion":
-        cwl = os.path.join(os.path.dirname(__file__),"..","FusionDetection","cwl","FusionEvalWorkflow.cwl")
         truth = os.path.abspath(os.path.join(args.dir, args.input + "_filtered.bedpe"))
-        annots = syn.get("syn5908245")
-        annotations = annots.path
-        call_evaluation(cwl, workflow_out, truth, annotations, args.no_cache, cachedir=args.cachedir)
-    #elif args.challenge == "fusionQuant":
-        cwl = os.path.join(os.path.dirname(__file__),"..","FusionQuantification","cwl","FusionQuantWorkflow.cwl")
-        truth = os.path.abspath(os.path.join(args.dir, args.input + "_filtered.bedpe"))
-        annots = syn.get("syn5908245")
-        annotations = None
+        return [("detection",
+                 os.path.join(os.path.dirname(__file__),"..","FusionDetection","cwl","FusionEvalWorkflow.cwl"),
+                 truth, synapse_file(syn, "syn5908245", args)),
+                ("quantification",
+                 os.path.join(os.path.dirname(__file__),"..","FusionQuantification","cwl","FusionQuantWorkflow.cwl"),
+                 truth, None)]
     elif args.challenge == "isoform":
         cwl = os.path.join(os.path.dirname(__file__),"..","IsoformQuantification","cwl","QuantificationEvalWorkflow.cwl")
         truth = os.path.abspath(os.path.join(args.dir, args.input + "_isoforms_truth.txt"))
         annotations = os.path.abspath(os.path.join(args.dir, "Homo_sapiens.GRCh37.75.gtf"))
-    else:
-        raise ValueError("Please pick either 'fusion' or 'isoform' for challenges")
-    call_evaluation(cwl, workflow_out, truth, annotations, args.no_cache, cachedir=args.cachedir)
+        return [("isoform", cwl, truth, annotations)]
+    raise ValueError("Please pick either 'fusion' or 'isoform' for challenges")
+
+def workflow_resources(cwlpath, seen=None):
+    """
+    The most cores and memory (MB) that a step of a workflow asks for in a
+    ResourceRequirement, following the tools it runs. None when not given.
+    """
+    if seen is None:
+        seen = set()
+    cwlpath = os.path.abspath(cwlpath)
+    if cwlpath in seen:
+        return None, None
+    seen.add(cwlpath)
+    with open(cwlpath) as handle:
+        doc = yaml.load(handle.read())
+    cpus = None
+    memory = None
+    docs = doc.get('$graph', [doc])
+    for item in docs:
+        reqs = []
+        for field in ['requirements', 'hints']:
+            value = item.get(field, [])
+            if isinstance(value, dict):
+                value = [dict(v, **{'class': k}) for k, v in value.items()]
+            reqs.extend(value)
+        for req in reqs:
+            if req.get('class') == 'ResourceRequirement':
+                if isinstance(req.get('coresMin'), (int, float)):
+                    cpus = max(cpus, req['coresMin'])
+                if isinstance(req.get('ramMin'), (int, float)):
+                    memory = max(memory, req['ramMin'])
+        for step in item.get('steps', []):
+            run = step.get('run')
+            if isinstance(run, basestring) and not run.startswith("#"):
+                step_cpus, step_memory = workflow_resources(os.path.join(os.path.dirname(cwlpath), run), seen)
+                cpus = max(cpus, step_cpus)
+                memory = max(memory, step_memory)
+    return cpus, memory
+
+class ResourceBudget(object):
+    """
+    Cores and memory (MB) shared by the runs of a test matrix. A run waits
+    until what it asks for is free; more than the whole budget is clamped
+    to it, and the run then has the machine to itself.
+    """
+
+    def __init__(self, cpus, memory):
+        self.total = (cpus, memory)
+        self.cpus = cpus
+        self.memory = memory
+        self.condition = threading.Condition()
+
+    def acquire(self, cpus, memory):
+        cpus = min(cpus, self.total[0])
+        memory = min(memory, self.total[1])
+        with self.condition:
+            while self.cpus < cpus or self.memory < memory:
+                self.condition.wait()
+            self.cpus -= cpus
+            self.memory -= memory
+        return cpus, memory
+
+    def release(self, cpus, memory):
+        with self.condition:
+            self.cpus += cpus
+            self.memory += memory
+            self.condition.notify_all()
+
+def call_with_budget(budget, cpus, memory, func, *args, **kwargs):
+    cpus, memory = budget.acquire(cpus, memory)
+    try:
+        return func(*args, **kwargs)
+    finally:
+        budget.release(cpus, memory)
+
+def total_memory():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / (1024 * 1024)
+    except (ValueError, OSError, AttributeError):
+        return MATRIX_DEFAULT_MEMORY
+
+def matrix_job(job):
+    """
+    Runs a workflow on a sample then its evaluations, returns the rows of the
+    score table. A run that raises gets an error row like a failed one, so
+    that the other runs of the matrix still make it to the table.
+    """
+    budget = job['budget']
+    args = job['args']
+    label = "%s %s" % (job['sample'], os.path.basename(job['workflow']))
+    rows = []
+    try:
+        workflow_out = call_with_budget(budget, job['cpus'], job['memory'], call_cwl,
+                                        job['workflow'], [job['inputs']], args.no_cache,
+                                        args.cachedir, os.path.join(job['outdir'], "workflow"), label)
+    except Exception as e:
+        traceback.print_exc()
+        return [(job['sample'], job['workflow'], "workflow", "error", None, "%s: %s" % (type(e).__name__, e))]
+    if not workflow_out.ok:
+        return [(job['sample'], job['workflow'], "workflow", "error", workflow_out, workflow_out.error)]
+    for name, cwl, truth, annotations in job['evaluations']:
+        out = None
+        try:
+            out = call_with_budget(budget, EVALUATION_CPUS, EVALUATION_MEMORY, call_evaluation,
+                                   cwl, workflow_out.output_path, truth, annotations, args.no_cache,
+                                   args.cachedir, os.path.join(job['outdir'], name), "%s %s" % (label, name))
+            if not out.ok or out.output_path is None or not os.path.exists(out.output_path):
+                rows.append((job['sample'], job['workflow'], name, "error", out, out.error or "The evaluation has no output"))
+                continue
+            with open(out.output_path) as handle:
+                lines = [line for line in handle.read().split("\n") if line.strip() != ""]
+        except Exception as e:
+            traceback.print_exc()
+            rows.append((job['sample'], job['workflow'], name, "error", out, "%s: %s" % (type(e).__name__, e)))
+            continue
+        for line in lines:
+            rows.append((job['sample'], job['workflow'], name, "ok", out, line))
+    return rows
+
+def run_matrix(syn,args):
+    check_bucket()
+    samples = args.samples
+    if not samples:
+        samples = list_samples()
+    workflows = [os.path.abspath(workflow) for workflow in args.workflow]
+
+    print("Caching Reference and Inputs files", file=sys.stderr)
+    files = reference_files(args)
+    for sample in samples:
+        sample_args = copy.copy(args)
+        sample_args.input = sample
+        files.extend(dataset_files(sample_args))
+    fetch(args, files)
+
+    cpus = args.cpus or multiprocessing.cpu_count()
+    memory = args.memory or total_memory()
+    budget = ResourceBudget(cpus, memory)
+    print("Running %d samples x %d workflows with %d cores and %d MB" % (len(samples), len(workflows), cpus, memory), file=sys.stderr)
+
+    #The inputs are prepared here, Synapse downloads are not shared by threads
+    jobs = []
+    for workflow in workflows:
+        job_cpus, job_memory = workflow_resources(workflow)
+        for sample in samples:
+            job_args = copy.copy(args)
+            job_args.input = sample
+            job_args.workflow = workflow
+            outdir = os.path.abspath(os.path.join(args.dir, "matrix", os.path.splitext(os.path.basename(workflow))[0], sample))
+            refstore.makedirs(outdir)
+            jobs.append({
+                'args' : args,
+                'budget' : budget,
+                'sample' : sample,
+                'workflow' : workflow,
+                'outdir' : outdir,
+                'cpus' : args.job_cpus or job_cpus or MATRIX_DEFAULT_CPUS,
+                'memory' : args.job_memory or job_memory or MATRIX_DEFAULT_MEMORY,
+                'inputs' : write_inputs(outdir, gen_inputs(syn, job_args, fetch_data=False)),
+                'evaluations' : evaluation_runs(syn, job_args)
+            })
+
+    pool = ThreadPool(max(1, len(jobs)))
+    try:
+        results = pool.map(matrix_job, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+    table = ["sample\tworkflow\tevaluation\tstatus\tseconds\tcpu_seconds\tmax_rss_mb\tresult"]
+    for rows in results:
+        for sample, workflow, name, status, run, result in rows:
+            usage = "\t\t" if run is None else "%.0f\t%.0f\t%.0f" % (run.wall, run.cpu, run.max_rss / 1024.0)
+            table.append("%s\t%s\t%s\t%s\t%s\t%s" % (sample, os.path.basename(workflow), name, status, usage, result))
+    with open(args.out, "w") as handle:
+        handle.write("\n".join(table) + "\n")
+    print("\n".join(table))
 
 def run_inputs(syn,args):
     in_req = gen_inputs(syn,args)
     print(json.dumps(in_req, indent=4))
 
-def run_list(syn,args):
-    cmd = ["gsutil", "ls", "%s/training/*.fq.gz" % (DREAM_RNA_BUCKET)]
-    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-    stdout, stderr = proc.communicate()
+def list_samples():
+    objects = fetcher.list_objects(DREAM_RNA_BUCKET, "training/*.fq.gz", stat=False)
     out = []
-    for line in stdout.split("\n"):
-        if line.startswith("gs://"):
-            res = re.search(r'(sim.*)_merge', line)
-            if res:
-                if res.group(1) not in out:
-                    out.append(res.group(1))
-    print("\n".join(out))
+    for name in sorted(objects):
+        res = re.search(r'(sim.*)_merge', name)
+        if res:
+            if res.group(1) not in out:
+                out.append(res.group(1))
+    return out
+
+def run_list(syn,args):
+    print("\n".join(list_samples()))
 
 def perform_main(args):
     synapse = synapse_login()
@@ -222,6 +471,16 @@ def perform_main(args):
             print(traceback.print_exc())
             print(ex)
 
+def add_fetch_arguments(parser):
+    parser.add_argument('--workers', type=int, default=fetcher.FETCH_WORKERS,
+        help='Number of files downloaded at once')
+    parser.add_argument('--store', type=str, default=refstore.STORE_DEFAULT_DIR,
+        help='Reference store shared by the runs of this machine')
+    parser.add_argument('--store-size', type=float, default=refstore.STORE_DEFAULT_MAX_GB,
+        help='Size of the reference store in GB, least recently used files are removed beyond it')
+    parser.add_argument('--no-store', action='store_true',
+        help='Do not use the reference store')
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='DREAM runner - run your workflow from beginning to end.')
     
@@ -242,7 +501,9 @@ if __name__ == '__main__':
         help='download training or dry data')
     parser_download.add_argument('--dir', default="./", type=str, 
         help='Directory to download files to')
-    parser_download.add_argument('--bucket', default="gs://dream-smc-rna")
+    parser_download.add_argument('--bucket', default="gs://dream-smc-rna",
+        help='gs:// bucket, or a local directory laid out like it')
+    add_fetch_arguments(parser_download)
     parser_download.set_defaults(func=download)
     
     parser_test = subparsers.add_parser('test',help='Downloads training and dry-run data')
@@ -258,7 +519,9 @@ if __name__ == '__main__':
         help='Do not cache workflow steps')
     parser_test.add_argument("--cachedir", type=str, default="cwl-cache",
         help='Directory to cache cwl run')
-    parser_test.add_argument('--bucket', default="gs://dream-smc-rna")
+    parser_test.add_argument('--bucket', default="gs://dream-smc-rna",
+        help='gs:// bucket, or a local directory laid out like it')
+    add_fetch_arguments(parser_test)
     parser_test.set_defaults(func=run_test)
 
     parser_inputs = subparsers.add_parser('inputs',help='Create Input JSON')
@@ -274,9 +537,39 @@ if __name__ == '__main__':
         help='Do not cache workflow steps')
     parser_inputs.add_argument("--cachedir", type=str, default="cwl-cache",
         help='Directory to cache cwl run')
-    parser_inputs.add_argument('--bucket', default="gs://dream-smc-rna")
+    parser_inputs.add_argument('--bucket', default="gs://dream-smc-rna",
+        help='gs:// bucket, or a local directory laid out like it')
+    add_fetch_arguments(parser_inputs)
     parser_inputs.set_defaults(func=run_inputs)
     
+    parser_matrix = subparsers.add_parser('test-matrix',help='Runs workflows on several training/debugging datasets at once')
+    parser_matrix.add_argument("challenge", type = str,
+        help='Choose the challenge question: fusion or isoform')
+    parser_matrix.add_argument("--workflow", type=str, action='append', required=True,
+        help='Non merged workflow file, can be given more than once')
+    parser_matrix.add_argument("--samples", type=str, nargs='+',
+        help='Training/debugging datasets to use. Default: all the training datasets')
+    parser_matrix.add_argument("--dir", type=str, default="./",
+        help='Directory to download data to')
+    parser_matrix.add_argument("--out", type=str, default="test_matrix.tsv",
+        help='Score table')
+    parser_matrix.add_argument("--cpus", type=int,
+        help='Cores used by all the runs. Default: all the cores')
+    parser_matrix.add_argument("--memory", type=int,
+        help='Memory in MB used by all the runs. Default: all the memory')
+    parser_matrix.add_argument("--job-cpus", type=int,
+        help='Cores of a workflow run. Default: its ResourceRequirement, or %d' % MATRIX_DEFAULT_CPUS)
+    parser_matrix.add_argument("--job-memory", type=int,
+        help='Memory in MB of a workflow run. Default: its ResourceRequirement, or %d' % MATRIX_DEFAULT_MEMORY)
+    parser_matrix.add_argument("--no-cache", action='store_true',
+        help='Do not cache workflow steps')
+    parser_matrix.add_argument("--cachedir", type=str, default="cwl-cache",
+        help='Directory to cache cwl run')
+    parser_matrix.add_argument('--bucket', default="gs://dream-smc-rna",
+        help='gs:// bucket, or a local directory laid out like it')
+    add_fetch_arguments(parser_matrix)
+    parser_matrix.set_defaults(func=run_matrix)
+
     parser_list = subparsers.add_parser('list',help='List Avalible tumors')
     parser_list.add_argument('--bucket', default="gs://dream-smc-rna")
     parser_list.set_defaults(func=run_list)
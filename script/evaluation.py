@@ -5,16 +5,39 @@ import sys
 import argparse
 import subprocess
 
-def evaluateFusionDet(args):
-	validator_path = os.path.join(os.path.dirname(__file__), "..", "FusionDetection", "Validator", "bedpeValidatorS.py")
-	chrom_path = os.path.join(os.path.dirname(__file__), "..", "FusionDetection", "Validator", "GRCh37.chromosome.strict.txt")
-	rule_file = os.path.join(os.path.dirname(__file__), "..", "FusionDetection", "Evaluator", "rulefile.txt")
+#The validators and evaluators are imported so that they run in this process
+for path in [("FusionDetection", "Validator"),
+	     ("FusionQuantification", "Evaluator"),
+	     ("IsoformQuantification", "Validator"),
+	     ("IsoformQuantification", "Evaluator")]:
+	sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", *path))
+import bedpeValidatorS
+import fusionQuantificationEvaluator
+import quantificationValidator
+import quantificationEvaluator
+
+def validateBedpe(chrom_path, input):
+	"""
+	Returns what bedpeValidatorS.py prints, "Validated\n" or the messages
+	that made the validation fail, and the validated rows.
+	"""
+	notes = []
+	rows = []
 	try:
-		val = subprocess.Popen([validator_path, "-c", chrom_path, "-i",args.input],stdout=subprocess.PIPE)
-		output = val.stdout.read()
+		table = bedpeValidatorS.load_chromosome_table(chrom_path)
+		rows = bedpeValidatorS.validate_file(input, table, notes)
+		output = "Validated\n"
+	except bedpeValidatorS.ValidationError as e:
+		output = "%s\n" % e
 	except Exception as e:
 		output = str(e)
 		print(output)
+	return "".join(["%s\n" % note for note in notes]) + output, rows
+
+def evaluateFusionDet(args):
+	chrom_path = os.path.join(os.path.dirname(__file__), "..", "FusionDetection", "Validator", "GRCh37.chromosome.strict.txt")
+	rule_file = os.path.join(os.path.dirname(__file__), "..", "FusionDetection", "Evaluator", "rulefile.txt")
+	output, rows = validateBedpe(chrom_path, args.input)
 	if output == "Validated\n":
 		evaluate = subprocess.check_call(["fusionToolEvaluator", "-t", args.truth,"-r",args.input,"-g", args.gtf,"-s",rule_file,"-o","detection_result.out","-a"])
 	else:
@@ -23,33 +46,39 @@ def evaluateFusionDet(args):
 			results.close()
 
 def evaluateFusionQuant(args):
-	validator_path = os.path.join(os.path.dirname(__file__), "..", "FusionDetection", "Validator", "bedpeValidatorS.py")
 	chrom_path = os.path.join(os.path.dirname(__file__), "..", "FusionDetection", "Validator", "GRCh37.chromosome.strict.txt")
-	evaluator_path = os.path.join(os.path.dirname(__file__), "..", "FusionQuantification", "Evaluator", "fusionQuantificationEvaluator.py")
-	try:
-		val = subprocess.Popen([validator_path, "-c", chrom_path, "-i",args.input],stdout=subprocess.PIPE)
-		output = val.stdout.read()
-	except Exception as e:
-		output = str(e)
-		print(output)
+	output, rows = validateBedpe(chrom_path, args.input)
 	if output == "Validated\n":
-		evaluate = subprocess.check_call([evaluator_path, "-t", args.truth,"-i",args.input])
+		#score the rows the validator parsed instead of reading the input again,
+		#with the strict chromosome file their names are unchanged
+		truth = fusionQuantificationEvaluator.load_truth(args.truth)
+		result = fusionQuantificationEvaluator.score_fusion_rows(truth, rows)
+		print(result['cor'])
+		with open("quantification_result.out",'w') as results:
+			results.write(result['cor'])
+			results.close()
 	else:
 		with open("result.out",'w') as results:
 			results.write(output)
 			results.close()
 
 def evaluateIsoformQuant(args):
-	validator_path = os.path.join(os.path.dirname(__file__), "..", "IsoformQuantification", "Validator", "quantificationValidator.py")
-	evaluator_path = os.path.join(os.path.dirname(__file__), "..", "IsoformQuantification", "Evaluator", "quantificationEvaluator.py")
+	truth = quantificationEvaluator.StratifiedTruth(args.truth)
 	try:
-		val = subprocess.Popen([validator_path, "-g", args.gtf, "-i", args.input],stdout=subprocess.PIPE)
-		output = val.stdout.read()
+		transcripts = None
+		if args.check_model:
+			transcripts = quantificationValidator.loadTranscriptNames(args.gtf)
+		#the input is read once, each row is validated as it is scored
+		result = truth.scoreRecords(quantificationValidator.validRecords(args.input, transcripts))
+		output = "Validated\n"
+	except quantificationValidator.ValidationError as e:
+		output = "%s\n" % e
 	except Exception as e:
 		output = str(e)
 		print(output)
 	if output == "Validated\n":
-		evaluate = subprocess.check_call([evaluator_path, "-t", args.truth, "-i", args.input])
+		quantificationEvaluator.printResult(result)
+		quantificationEvaluator.writeResults("./result", result['cor'], result['fdr'])
 	else:
 		with open("result.out",'w') as results:
 			results.write(output)
@@ -76,6 +105,7 @@ parser_evaluateIsoformQuant.add_argument('--gtf', help='Gene annotation file', m
 parser_evaluateIsoformQuant.add_argument('--input',  metavar='results.out', type=str, required=True,
 		help='transcriptId, TPM'),
 parser_evaluateIsoformQuant.add_argument('--truth', help='Truth file', metavar='truth.isoforms.txt',type=str,required=True)
+parser_evaluateIsoformQuant.add_argument('--check-model', help='Transcripts must be in the gene annotation file', action='store_true')
 parser_evaluateIsoformQuant.set_defaults(func=evaluateIsoformQuant)
 
 parser_evaluateFusionDet = subparsers.add_parser('evaluateFusionDet',
@@ -0,0 +1,349 @@
+#
+# Concurrent, checksum-verified downloads of the challenge data for
+# dream_runner.py.
+#
+# The bucket is either a gs:// url, read with gsutil, or a local directory
+# laid out like the bucket. Each fetched file is checked against the size and
+# md5 of its object, or its crc32c for composite objects which have no md5,
+# and recorded in a manifest next to the downloaded files, so that a later
+# run skips it only if it is complete and the object has not changed since.
+# Files of a local bucket are only hashed again when their size or
+# modification time changed. Files are written to <file>.part and renamed once verified,
+# an interrupted download resumes from the end of its .part file. Gzipped
+# objects can be decompressed while they stream in.
+#
+# With a refstore.RefStore, fetched files are shared by all the download
+# directories of the machine, and an object already in the store is linked
+# rather than downloaded.
+
+from __future__ import print_function
+
+import os
+import sys
+import glob
+import json
+import zlib
+import base64
+import hashlib
+import binascii
+import tempfile
+import threading
+import subprocess
+from multiprocessing.pool import ThreadPool
+
+try:
+    import crcmod.predefined
+except ImportError:
+    crcmod = None
+
+FETCH_WORKERS = 4
+FETCH_CHUNK_SIZE = 1024 * 1024
+MANIFEST_NAME = "dream_runner.manifest.json"
+
+
+class FetchError(Exception):
+    pass
+
+
+def is_gs(bucket):
+    return bucket.startswith("gs://")
+
+
+def object_path(bucket, name):
+    if is_gs(bucket):
+        return "%s/%s" % (bucket.rstrip("/"), name)
+    return os.path.join(bucket, name)
+
+
+def hex_from_base64(value):
+    return binascii.hexlify(base64.b64decode(value)).decode("ascii")
+
+
+def new_digest(name, remote):
+    """
+    The hash an object is checked with: md5, or crc32c, computed with crcmod
+    as gsutil does, for a composite object
+    """
+    if remote['md5'] is not None:
+        return hashlib.md5()
+    if remote.get('crc32c') is None:
+        raise FetchError("%s has no checksum to be verified with" % name)
+    if crcmod is None:
+        raise FetchError("%s is a composite object, checking its crc32c needs crcmod: pip install crcmod" % name)
+    return crcmod.predefined.Crc('crc32c')
+
+
+def expected_digest(remote):
+    if remote['md5'] is not None:
+        return remote['md5']
+    return remote.get('crc32c')
+
+
+def hash_file(path, digest):
+    """Feed the content of a file to digest, returns its size"""
+    size = 0
+    with open(path, "rb") as handle:
+        while True:
+            chunk = handle.read(FETCH_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            size += len(chunk)
+    return size
+
+
+def parse_gsutil_listing(bucket, text):
+    """
+    Parse the output of 'gsutil ls -L' or 'gsutil stat' into a dictionary of
+    object name to {'size', 'md5', 'crc32c'}. Composite objects have no md5.
+    """
+    objects = {}
+    prefix = bucket.rstrip("/") + "/"
+    current = None
+    for line in text.split("\n"):
+        if line.startswith("gs://") and line.rstrip().endswith(":"):
+            current = {'size': None, 'md5': None, 'crc32c': None}
+            objects[line.rstrip()[len(prefix):-1]] = current
+        elif current is not None:
+            fields = line.strip().split(":", 1)
+            if fields[0] == "Content-Length":
+                current['size'] = int(fields[1])
+            elif fields[0] == "Hash (md5)":
+                current['md5'] = hex_from_base64(fields[1].strip())
+            elif fields[0] == "Hash (crc32c)":
+                current['crc32c'] = hex_from_base64(fields[1].strip())
+    return objects
+
+
+def list_objects(bucket, pattern, stat=True, manifest=None):
+    """
+    Returns the objects of the bucket whose name matches a wildcard pattern,
+    as a dictionary of name to {'size', 'md5', 'crc32c'}, or to None if stat
+    is False.
+
+    The files of a local bucket also have their 'mtime', and the md5 recorded
+    in manifest is used for those whose size and mtime are unchanged.
+    """
+    if is_gs(bucket):
+        cmd = ["gsutil", "ls"]
+        if stat:
+            cmd.append("-L")
+        cmd.append(object_path(bucket, pattern))
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        stdout, stderr = proc.communicate()
+        if proc.returncode != 0:
+            raise FetchError("Unable to list %s" % object_path(bucket, pattern))
+        stdout = stdout.decode("utf-8")
+        if stat:
+            return parse_gsutil_listing(bucket, stdout)
+        prefix = bucket.rstrip("/") + "/"
+        return dict((line[len(prefix):], None) for line in stdout.split("\n") if line.startswith(prefix))
+    objects = {}
+    for path in glob.glob(object_path(bucket, pattern)):
+        if not os.path.isfile(path):
+            continue
+        name = os.path.relpath(path, bucket).replace(os.sep, "/")
+        objects[name] = None
+        if not stat:
+            continue
+        st = os.stat(path)
+        entry = manifest.get(name) if manifest is not None else None
+        if entry is not None and entry['size'] == st.st_size and entry.get('mtime') == st.st_mtime:
+            objects[name] = {'size': st.st_size, 'md5': entry['md5'], 'crc32c': None, 'mtime': st.st_mtime}
+            continue
+        digest = hashlib.md5()
+        size = hash_file(path, digest)
+        objects[name] = {'size': size, 'md5': digest.hexdigest(), 'crc32c': None, 'mtime': st.st_mtime}
+    return objects
+
+
+class GsutilStream(object):
+    """Reads an object, from offset on, through 'gsutil cat'"""
+
+    def __init__(self, url, offset=0):
+        cmd = ["gsutil", "cat"]
+        if offset:
+            cmd.extend(["-r", "%d-" % offset])
+        cmd.append(url)
+        self.url = url
+        self.proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+
+    def read(self, size):
+        return self.proc.stdout.read(size)
+
+    def close(self):
+        self.proc.stdout.close()
+        if self.proc.wait() != 0:
+            raise FetchError("gsutil cat %s failed" % self.url)
+
+
+def open_object(bucket, name, offset=0):
+    if is_gs(bucket):
+        return GsutilStream(object_path(bucket, name), offset)
+    handle = open(object_path(bucket, name), "rb")
+    handle.seek(offset)
+    return handle
+
+
+class Manifest(object):
+    """
+    The objects fetched into a directory, with the size and checksums they
+    were verified against. Can be shared by threads.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as handle:
+                self.entries = json.load(handle)
+
+    def get(self, name):
+        with self.lock:
+            return self.entries.get(name)
+
+    def put(self, name, entry):
+        with self.lock:
+            self.entries[name] = entry
+            self.save()
+
+    def save(self):
+        ## written next to the manifest then renamed, so that an interrupted
+        ## run never leaves a truncated manifest
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)))
+        with os.fdopen(fd, "w") as handle:
+            json.dump(self.entries, handle, indent=2, sort_keys=True)
+        os.rename(tmp, self.path)
+
+
+def manifest_entry(remote, dest, complete=False):
+    return {'size': remote['size'], 'md5': remote['md5'], 'crc32c': remote.get('crc32c'),
+            'mtime': remote.get('mtime'), 'path': dest, 'complete': complete,
+            'local_size': os.path.getsize(dest) if complete else None}
+
+
+def same_object(entry, remote):
+    return entry['size'] == remote['size'] and entry['md5'] == remote['md5'] and \
+        entry.get('crc32c') == remote.get('crc32c')
+
+
+def is_fetched(manifest, name, remote, dest):
+    entry = manifest.get(name)
+    return entry is not None and entry['complete'] and same_object(entry, remote) and \
+        entry['path'] == os.path.abspath(dest) and \
+        os.path.exists(dest) and os.path.getsize(dest) == entry['local_size']
+
+
+def store_key(name, remote, gunzip):
+    return "object:%s:%d:%s:%s" % (name, remote['size'], remote['md5'], "gunzip" if gunzip else "raw")
+
+
+def fetch_file(bucket, name, remote, dest, manifest, gunzip=False, store=None):
+    """
+    Download an object of the bucket to dest, decompressing it on the fly if
+    gunzip is True, and check it against the size and md5, or crc32c, in
+    remote.
+    Returns False if dest was already fetched and is up to date.
+
+    If a store is given, dest is linked to the file stored for the object,
+    or the downloaded file is added to the store. Objects without an md5
+    are not stored.
+
+    A download that fails midway keeps its .part file and is resumed by the
+    next call, unless it is decompressed: those restart from the beginning.
+    A file that does not match its checksum is removed.
+    """
+    if is_fetched(manifest, name, remote, dest):
+        return False
+    dest = os.path.abspath(dest)
+    if remote['md5'] is None:
+        store = None
+    if store is not None and store.link(store_key(name, remote, gunzip), dest):
+        print("Linked %s from the reference store" % name, file=sys.stderr)
+        manifest.put(name, manifest_entry(remote, dest, complete=True))
+        return True
+    part = dest + ".part"
+    entry = manifest.get(name)
+    digest = new_digest(name, remote)
+    offset = 0
+    if not gunzip and os.path.exists(part) and entry is not None and same_object(entry, remote):
+        offset = hash_file(part, digest)
+        if offset > remote['size']:
+            digest = new_digest(name, remote)
+            offset = 0
+    manifest.put(name, manifest_entry(remote, dest))
+    if offset == remote['size'] and offset > 0:
+        ## interrupted after the last write, before the rename
+        print("Verifying %s" % name, file=sys.stderr)
+    elif offset:
+        print("Resuming %s at %d bytes" % (name, offset), file=sys.stderr)
+    else:
+        print("Fetching %s" % name, file=sys.stderr)
+
+    size = offset
+    if offset == 0 or offset < remote['size']:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if gunzip else None
+        source = open_object(bucket, name, offset)
+        with open(part, "ab" if offset else "wb") as out:
+            try:
+                while True:
+                    chunk = source.read(FETCH_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    digest.update(chunk)
+                    if decompressor is None:
+                        out.write(chunk)
+                        continue
+                    data = decompressor.decompress(chunk)
+                    ## a file can hold several gzip members one after another
+                    while decompressor.unused_data:
+                        rest = decompressor.unused_data
+                        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                        data += decompressor.decompress(rest)
+                    out.write(data)
+                if decompressor is not None:
+                    out.write(decompressor.flush())
+            finally:
+                source.close()
+
+    checksum = digest.hexdigest().lower()
+    if size != remote['size'] or checksum != expected_digest(remote):
+        os.remove(part)
+        raise FetchError("%s does not match its checksum (%d bytes, %s %s, expected %d bytes, %s)" %
+                         (name, size, "md5" if remote['md5'] is not None else "crc32c", checksum,
+                          remote['size'], expected_digest(remote)))
+    os.rename(part, dest)
+    if store is not None:
+        store.add(store_key(name, remote, gunzip), dest)
+    manifest.put(name, manifest_entry(remote, dest, complete=True))
+    return True
+
+
+def fetch_one(task):
+    bucket, name, remote, dest, manifest, gunzip, store = task
+    try:
+        return fetch_file(bucket, name, remote, dest, manifest, gunzip, store), None
+    except FetchError as e:
+        return False, str(e)
+    except Exception as e:
+        return False, "%s: %s" % (name, e)
+
+
+def fetch_all(bucket, files, manifest, workers=FETCH_WORKERS, store=None):
+    """
+    Fetch (name, remote, dest, gunzip) tuples concurrently, see fetch_file.
+    Raises FetchError once all are done if any of them failed.
+    """
+    tasks = [(bucket, name, remote, dest, manifest, gunzip, store) for name, remote, dest, gunzip in files]
+    pool = ThreadPool(max(1, min(workers, len(tasks))))
+    try:
+        results = pool.map(fetch_one, tasks)
+    finally:
+        pool.close()
+        pool.join()
+    errors = [error for fetched, error in results if error is not None]
+    if errors:
+        raise FetchError("Unable to fetch:\n" + "\n".join(errors))
+    return [task[3] for task, (fetched, error) in zip(tasks, results) if fetched]
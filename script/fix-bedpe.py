@@ -1,18 +1,22 @@
 import argparse
 import logging
+import os
 import sys
 
+VALIDATOR_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "..", "FusionDetection", "Validator")
+sys.path.insert(0, VALIDATOR_DIR)
+from chromosomeTable import load_chromosome_table
+
 
 parser = argparse.ArgumentParser()
 parser.add_argument("bedpe")
+parser.add_argument("-c", "--chromosome-file",
+                    default=os.path.join(VALIDATOR_DIR, "GRCh37.chromosome.txt"),
+                    help="chromosome names allowed by the validator")
 
 logging.basicConfig(level=logging.INFO)
 
-valid_chrom = [
-    '1', '2', '3', '4', '5', '6', '7', '8', '9', '10',
-    '11', '12', '13', '14', '15', '16', '17', '18', '19',
-    '20', '21', '22', 'x', 'y', 'mt',
-]
 valid_strand = ['+', '-', '.']
 
 
@@ -43,10 +47,10 @@ class InvalidStartEnd1(Exception): pass
 class InvalidStartEnd2(Exception): pass
 
 
-def validate_bedpe_row(row):
-    if row.chrom1.lower() not in valid_chrom:
+def validate_bedpe_row(row, valid_chrom):
+    if row.chrom1 not in valid_chrom:
         raise InvalidChrom1()
-    if row.chrom2.lower() not in valid_chrom:
+    if row.chrom2 not in valid_chrom:
         raise InvalidChrom2()
     if row.strand1 not in valid_strand:
         raise InvalidStrand1()
@@ -89,7 +93,7 @@ def format_row(row):
     ] + list(row.extra))
 
 
-def parse(path):
+def parse(path, valid_chrom):
     rows = open(path).read().splitlines()
     outputs = []
     for i, line in enumerate(rows):
@@ -102,7 +106,7 @@ def parse(path):
         row.start1, row.end1 = fix_start_end(row.start1, row.end1)
 
         try:
-            validate_bedpe_row(row)
+            validate_bedpe_row(row, valid_chrom)
         except InvalidChrom1:
             m = "Dropping row. Invalid chrom 1 on row {}: '{}'"
             m = m.format(i, row.chrom1)
@@ -134,10 +138,14 @@ def parse(path):
             logging.error(m)
             sys.exit(1)
 
+        # The evaluation validates against the strict table, which only
+        # allows the target names
+        row.chrom1 = valid_chrom.get(row.chrom1)[0]
+        row.chrom2 = valid_chrom.get(row.chrom2)[0]
         outputs.append(format_row(row))
 
     sys.stdout.write('\n'.join(outputs))
 
 if __name__ == "__main__":
     args = parser.parse_args()
-    parse(args.bedpe)
+    parse(args.bedpe, load_chromosome_table(args.chromosome_file))
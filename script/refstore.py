@@ -0,0 +1,166 @@
+#
+# Content-addressed store of the reference data used by dream_runner.py,
+# shared by all the runs on a machine.
+#
+# Each file is kept once under objects/<sha256> and the download directories
+# of the runs hardlink to it, or symlink when the store is on another file
+# system. Files are found by a key naming where they come from (a bucket
+# object with its md5, a Synapse entity version), kept under keys/. Stored
+# files are read-only, so a workflow cannot change the copy other runs use.
+#
+# The store is kept under a size cap by removing the least recently used
+# files. A file that is still hardlinked from a download directory is never
+# removed, nor is one linked by the RefStore doing the removal; a file
+# symlinked by an earlier run is, and is fetched again by the next run.
+
+from __future__ import print_function
+
+import os
+import sys
+import stat
+import errno
+import shutil
+import hashlib
+import tempfile
+
+STORE_DEFAULT_DIR = os.path.join(os.path.expanduser("~"), ".dream_runner", "store")
+STORE_DEFAULT_MAX_GB = 200
+STORE_CHUNK_SIZE = 1024 * 1024
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as handle:
+        while True:
+            chunk = handle.read(STORE_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def replace_with_link(target, dest):
+    """Make dest a hardlink to target, or a symlink across file systems"""
+    if os.path.exists(dest) and os.path.samefile(target, dest):
+        return
+    tmp = "%s.link.%d" % (dest, os.getpid())
+    try:
+        os.link(target, tmp)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        os.symlink(os.path.abspath(target), tmp)
+    os.rename(tmp, dest)
+
+
+class RefStore(object):
+
+    def __init__(self, root=STORE_DEFAULT_DIR, max_bytes=STORE_DEFAULT_MAX_GB * 1024 ** 3):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.objects = os.path.join(root, "objects")
+        self.keys = os.path.join(root, "keys")
+        ## the files linked by this run, kept from eviction
+        self.in_use = set()
+        makedirs(self.objects)
+        makedirs(self.keys)
+
+    def key_path(self, key):
+        return os.path.join(self.keys, hashlib.sha1(key.encode("utf-8")).hexdigest())
+
+    def lookup(self, key):
+        """Returns the stored file of a key, or None, and marks it as used"""
+        try:
+            with open(self.key_path(key)) as handle:
+                digest = handle.read().strip()
+        except IOError:
+            return None
+        path = os.path.join(self.objects, digest)
+        if not os.path.exists(path):
+            ## the file was evicted
+            return None
+        self.in_use.add(digest)
+        try:
+            os.utime(path, None)
+        except OSError:
+            ## stored by another user
+            pass
+        return path
+
+    def link(self, key, dest):
+        """Make dest a link to the stored file of key, returns False if there is none"""
+        path = self.lookup(key)
+        if path is None:
+            return False
+        replace_with_link(path, dest)
+        return True
+
+    def add(self, key, path):
+        """
+        Move a file into the store under key and leave a link to it in its
+        place. Identical files are stored once.
+        """
+        digest = file_sha256(path)
+        target = os.path.join(self.objects, digest)
+        self.in_use.add(digest)
+        if not os.path.exists(target):
+            fd, tmp = tempfile.mkstemp(dir=self.objects, prefix=".tmp")
+            os.close(fd)
+            try:
+                os.unlink(tmp)
+                os.link(path, tmp)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                shutil.copyfile(path, tmp)
+            os.chmod(tmp, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            os.rename(tmp, target)
+        try:
+            os.utime(target, None)
+        except OSError:
+            pass
+        replace_with_link(target, path)
+
+        fd, tmp = tempfile.mkstemp(dir=self.keys)
+        with os.fdopen(fd, "w") as handle:
+            handle.write(digest + "\n")
+        os.rename(tmp, self.key_path(key))
+        self.evict()
+        return target
+
+    def evict(self):
+        """
+        Remove the least recently used files until the store fits in
+        max_bytes, except those still linked
+        """
+        files = []
+        total = 0
+        for name in os.listdir(self.objects):
+            if name.startswith("."):
+                continue
+            try:
+                st = os.stat(os.path.join(self.objects, name))
+            except OSError:
+                continue
+            files.append((st.st_mtime, name, st.st_size, st.st_nlink))
+            total += st.st_size
+        files.sort()
+        for mtime, name, size, nlink in files:
+            if total <= self.max_bytes:
+                break
+            if nlink > 1 or name in self.in_use:
+                continue
+            print("Removing %s from the reference store" % name, file=sys.stderr)
+            try:
+                os.remove(os.path.join(self.objects, name))
+            except OSError:
+                continue
+            total -= size
@@ -0,0 +1,154 @@
+#
+# Tests of fetcher.py against a local directory laid out like the bucket.
+#
+#   python -m unittest discover -s script -p 'test_*.py'
+
+import os
+import sys
+import gzip
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fetcher
+
+DATA = b"".join(b"line %d of the object\n" % i for i in range(50000))
+
+
+class FetcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.bucket = os.path.join(self.root, "bucket")
+        self.dir = os.path.join(self.root, "out")
+        os.makedirs(os.path.join(self.bucket, "training"))
+        os.makedirs(self.dir)
+        with open(os.path.join(self.bucket, "training", "sample.fq"), "wb") as handle:
+            handle.write(DATA)
+        ## two gzip members one after another, as bgzip writes them
+        with open(os.path.join(self.bucket, "ref.fa.gz"), "wb") as handle:
+            for part in (DATA[:100000], DATA[100000:]):
+                with gzip.GzipFile(fileobj=handle, mode="wb") as member:
+                    member.write(part)
+        self.manifest = fetcher.Manifest(os.path.join(self.dir, fetcher.MANIFEST_NAME))
+        self.offsets = []
+        self.open_object = fetcher.open_object
+
+        def open_object(bucket, name, offset=0):
+            self.offsets.append(offset)
+            return self.open_object(bucket, name, offset)
+        fetcher.open_object = open_object
+
+    def tearDown(self):
+        fetcher.open_object = self.open_object
+        shutil.rmtree(self.root)
+
+    def remote(self, name):
+        return fetcher.list_objects(self.bucket, name)[name]
+
+    def read(self, path):
+        with open(path, "rb") as handle:
+            return handle.read()
+
+    def test_fetch_and_skip(self):
+        name = "training/sample.fq"
+        dest = os.path.join(self.dir, "sample.fq")
+        self.assertTrue(fetcher.fetch_file(self.bucket, name, self.remote(name), dest, self.manifest))
+        self.assertEqual(self.read(dest), DATA)
+        self.assertFalse(fetcher.fetch_file(self.bucket, name, self.remote(name), dest, self.manifest))
+        self.assertEqual(self.offsets, [0])
+
+    def test_resume(self):
+        name = "training/sample.fq"
+        dest = os.path.join(self.dir, "sample.fq")
+        remote = self.remote(name)
+        self.manifest.put(name, fetcher.manifest_entry(remote, dest))
+        with open(dest + ".part", "wb") as handle:
+            handle.write(DATA[:123456])
+        self.assertTrue(fetcher.fetch_file(self.bucket, name, remote, dest, self.manifest))
+        self.assertEqual(self.offsets, [123456])
+        self.assertEqual(self.read(dest), DATA)
+        self.assertFalse(os.path.exists(dest + ".part"))
+
+    def test_complete_part(self):
+        name = "training/sample.fq"
+        dest = os.path.join(self.dir, "sample.fq")
+        remote = self.remote(name)
+        self.manifest.put(name, fetcher.manifest_entry(remote, dest))
+        with open(dest + ".part", "wb") as handle:
+            handle.write(DATA)
+        self.assertTrue(fetcher.fetch_file(self.bucket, name, remote, dest, self.manifest))
+        self.assertEqual(self.offsets, [])
+        self.assertEqual(self.read(dest), DATA)
+        self.assertTrue(self.manifest.get(name)['complete'])
+
+    def test_corrupt_part(self):
+        name = "training/sample.fq"
+        dest = os.path.join(self.dir, "sample.fq")
+        remote = self.remote(name)
+        self.manifest.put(name, fetcher.manifest_entry(remote, dest))
+        with open(dest + ".part", "wb") as handle:
+            handle.write(b"x" * 1000)
+        self.assertRaises(fetcher.FetchError, fetcher.fetch_file, self.bucket, name, remote, dest, self.manifest)
+        self.assertFalse(os.path.exists(dest + ".part"))
+        self.assertTrue(fetcher.fetch_file(self.bucket, name, remote, dest, self.manifest))
+        self.assertEqual(self.read(dest), DATA)
+
+    def test_gunzip(self):
+        name = "ref.fa.gz"
+        dest = os.path.join(self.dir, "ref.fa")
+        fetched = fetcher.fetch_all(self.bucket, [(name, self.remote(name), dest, True)], self.manifest)
+        self.assertEqual(fetched, [dest])
+        self.assertEqual(self.read(dest), DATA)
+
+    def test_listing_reuses_md5(self):
+        name = "training/sample.fq"
+        dest = os.path.join(self.dir, "sample.fq")
+        fetcher.fetch_file(self.bucket, name, self.remote(name), dest, self.manifest)
+        hash_file = fetcher.hash_file
+        hashed = []
+        fetcher.hash_file = lambda path, digest: hashed.append(path) or hash_file(path, digest)
+        try:
+            remote = fetcher.list_objects(self.bucket, name, manifest=self.manifest)[name]
+            self.assertEqual(hashed, [])
+            self.assertEqual(remote['md5'], hashlib.md5(DATA).hexdigest())
+            ## a changed file is hashed again
+            path = os.path.join(self.bucket, name)
+            with open(path, "ab") as handle:
+                handle.write(b"more\n")
+            remote = fetcher.list_objects(self.bucket, name, manifest=self.manifest)[name]
+            self.assertEqual(hashed, [path])
+            self.assertEqual(remote['md5'], hashlib.md5(DATA + b"more\n").hexdigest())
+        finally:
+            fetcher.hash_file = hash_file
+
+    def test_parse_listing(self):
+        listing = ("gs://bucket/training/x.gz:\n"
+                   "\tContent-Length:\t\t12\n"
+                   "\tHash (crc32c):\t\tAAAAAA==\n"
+                   "gs://bucket/training/y.gz:\n"
+                   "\tContent-Length:\t\t0\n"
+                   "\tHash (crc32c):\t\tAAAAAA==\n"
+                   "\tHash (md5):\t\t1B2M2Y8AsgTpgAmY7PhCfg==\n"
+                   "TOTAL: 2 objects\n")
+        objects = fetcher.parse_gsutil_listing("gs://bucket", listing)
+        self.assertEqual(objects["training/x.gz"], {'size': 12, 'md5': None, 'crc32c': "00000000"})
+        self.assertEqual(objects["training/y.gz"]['md5'], "d41d8cd98f00b204e9800998ecf8427e")
+
+    @unittest.skipIf(fetcher.crcmod is None, "crcmod is not installed")
+    def test_crc32c(self):
+        name = "training/sample.fq"
+        dest = os.path.join(self.dir, "sample.fq")
+        crc = fetcher.crcmod.predefined.Crc('crc32c')
+        crc.update(DATA)
+        remote = {'size': len(DATA), 'md5': None, 'crc32c': crc.hexdigest().lower()}
+        self.assertTrue(fetcher.fetch_file(self.bucket, name, remote, dest, self.manifest))
+        remote['crc32c'] = "00000000"
+        os.remove(dest)
+        self.assertRaises(fetcher.FetchError, fetcher.fetch_file, self.bucket, name, remote, dest, self.manifest)
+
+
+if __name__ == "__main__":
+    unittest.main()